@@ -0,0 +1,270 @@
+"""
+    暗号処理の基本演算のマイクロベンチマーク
+
+    演算ごとに1秒あたりの実行回数と1回あたりの所要時間のパーセンタイルを表示し，
+    結果をJSONに書き出す．基準の結果(以前に書き出したJSON)を渡すと比較し，
+    threshold%より遅くなった演算があれば終了コード1で終わる
+
+    wallet_appディレクトリで実行する
+    $ python -m benchmarks.crypto --output bench.json
+    $ python -m benchmarks.crypto --baseline bench.json --threshold 10
+"""
+import contextlib
+import io
+import itertools
+import json
+import random
+import sys
+import time
+
+import utils
+from blockchain import BlockChain
+from crypt import (
+    G,
+    N,
+    P,
+    FieldElement,
+    PrivateKey,
+    encode_base58_checksum,
+    hash160,
+)
+
+# 1サンプルの最短時間(秒)．速い演算はこの時間に達するまでまとめて実行して1サンプルにする
+SAMPLE_MIN_SEC = 0.001
+# 入力を使い回すと結果のキャッシュに当たるので，演算ごとにこの数だけ入力を用意して順に使う
+INPUT_COUNT = 64
+# 回帰とみなす遅くなり方(%)
+DEFAULT_THRESHOLD = 10.0
+
+
+def _cycle(values):
+    """ 呼ぶたびにvaluesの次の要素を返す関数 """
+    return itertools.cycle(values).__next__
+
+
+def _blockchain():
+    """ 通常どおり初期化したBlockChain(ジェネシスブロック作成時の表示は捨てる) """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return BlockChain()
+
+
+def _field_op(op):
+    def setup(rand):
+        pairs = [(FieldElement(rand.randrange(1, P), P),
+                  FieldElement(rand.randrange(1, P), P))
+                 for _ in range(INPUT_COUNT)]
+        next_pair = _cycle(pairs)
+
+        def run():
+            a, b = next_pair()
+            op(a, b)
+        return run
+    return setup
+
+
+def _point_add(rand):
+    points = [rand.randrange(1, N) * G for _ in range(INPUT_COUNT + 1)]
+    next_pair = _cycle(list(zip(points, points[1:])))
+
+    def run():
+        p, q = next_pair()
+        p + q
+    return run
+
+
+def _rmul_generator(rand):
+    next_scalar = _cycle([rand.randrange(1, N) for _ in range(INPUT_COUNT)])
+
+    def run():
+        next_scalar() * G
+    return run
+
+
+def _rmul_point(rand):
+    point = rand.randrange(1, N) * G
+    next_scalar = _cycle([rand.randrange(1, N) for _ in range(INPUT_COUNT)])
+
+    def run():
+        next_scalar() * point
+    return run
+
+
+def _sign(rand):
+    private_key = PrivateKey(rand.randrange(1, N))
+    next_z = _cycle([rand.getrandbits(256) for _ in range(INPUT_COUNT)])
+
+    def run():
+        private_key.sign(next_z())
+    return run
+
+
+def _transactions(rand, count):
+    private_key = PrivateKey(rand.randrange(1, N))
+    point = private_key.point
+    sender_public_key = '{:064x}{:064x}'.format(point.x.num, point.y.num)
+    sender = point.address()
+    chain = _blockchain()
+    records = []
+    for i in range(count):
+        transaction = utils.sorted_dict_by_key({
+            'sender_blockchain_address': sender,
+            'recipient_blockchain_address': sender,
+            'value': float(i + 1)
+        })
+        signature = private_key.sign(chain.transaction_digest(transaction))
+        records.append((sender_public_key, (signature.r, signature.s),
+                        transaction))
+    return records
+
+
+def _verify_transaction_signature(rand):
+    """ 公開鍵はキャッシュに乗った状態で，署名の検証結果は覚えないようにして測る """
+    chain = _blockchain()
+    chain.public_key_cache = utils.LRUCache(INPUT_COUNT)
+    chain.signature_cache = utils.LRUCache(0)
+    next_record = _cycle(_transactions(rand, INPUT_COUNT))
+
+    def run():
+        if not chain.verify_transaction_signature(*next_record()):
+            raise AssertionError('signature did not verify')
+    return run
+
+
+def _hash160(rand):
+    next_data = _cycle([rand.getrandbits(8 * 33).to_bytes(33, 'big')
+                        for _ in range(INPUT_COUNT)])
+
+    def run():
+        hash160(next_data())
+    return run
+
+
+def _encode_base58_checksum(rand):
+    next_data = _cycle([b'\x00' + rand.getrandbits(8 * 20).to_bytes(20, 'big')
+                        for _ in range(INPUT_COUNT)])
+
+    def run():
+        encode_base58_checksum(next_data())
+    return run
+
+
+# (名前, 入力を用意して1回分の演算を行う関数を返すsetup)
+BENCHMARKS = [
+    ('FieldElement.__add__', _field_op(lambda a, b: a + b)),
+    ('FieldElement.__mul__', _field_op(lambda a, b: a * b)),
+    ('FieldElement.__pow__', _field_op(lambda a, b: a ** b.num)),
+    ('FieldElement.__truediv__', _field_op(lambda a, b: a / b)),
+    ('Point.__add__', _point_add),
+    ('S256Point.__rmul__ (G)', _rmul_generator),
+    ('S256Point.__rmul__ (point)', _rmul_point),
+    ('PrivateKey.sign', _sign),
+    ('BlockChain.verify_transaction_signature', _verify_transaction_signature),
+    ('hash160', _hash160),
+    ('encode_base58_checksum', _encode_base58_checksum),
+]
+
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1,
+                int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(run, samples):
+    """
+        runを繰り返し実行して計測結果のdictを返す
+        1回では短すぎる演算はSAMPLE_MIN_SEC以上になるまでまとめて実行し，
+        その平均を1回分の所要時間とする
+    """
+    run()
+    batch = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(batch):
+            run()
+        if time.perf_counter() - start >= SAMPLE_MIN_SEC:
+            break
+        batch *= 2
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        for _ in range(batch):
+            run()
+        latencies.append((time.perf_counter() - start) / batch)
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        'ops': samples * batch,
+        'ops_per_sec': len(latencies) / total,
+        'p50_us': _percentile(latencies, 50) * 1e6,
+        'p90_us': _percentile(latencies, 90) * 1e6,
+        'p99_us': _percentile(latencies, 99) * 1e6,
+    }
+
+
+def run_benchmarks(samples, names=None, seed=0):
+    rand = random.Random(seed)
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        results[name] = measure(setup(rand), samples)
+        print_row(name, results[name])
+    return results
+
+
+def print_header():
+    print(f'{"benchmark":42}{"ops/sec":>12}{"p50 us":>12}{"p90 us":>12}{"p99 us":>12}')
+
+
+def print_row(name, result):
+    print(f'{name:42}{result["ops_per_sec"]:12.1f}{result["p50_us"]:12.2f}'
+          f'{result["p90_us"]:12.2f}{result["p99_us"]:12.2f}')
+
+
+def compare(results, baseline, threshold):
+    """
+        基準の結果と比べて，ops/secがthreshold%より下がった演算の
+        (名前, 基準のops/sec, 今回のops/sec, 変化率%)のリストを返す
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['ops_per_sec']
+        after = result['ops_per_sec']
+        change = (after - before) / before * 100
+        if change < -threshold:
+            regressions.append((name, before, after, change))
+    return regressions
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--samples', default=100, type=int,
+                        help='number of samples per benchmark')
+    parser.add_argument('--only', action='append',
+                        help='run only the named benchmark (repeatable)')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with')
+    parser.add_argument('--threshold', default=DEFAULT_THRESHOLD, type=float,
+                        help='fail when ops/sec drops by more than this percentage')
+    args = parser.parse_args()
+
+    print_header()
+    results = run_benchmarks(args.samples, args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after, change in regressions:
+            print(f'REGRESSION {name}: {before:.1f} -> {after:.1f} ops/sec ({change:+.1f}%)')
+        if regressions:
+            sys.exit(1)
+        print(f'no regression over {args.threshold}% against {args.baseline}')
@@ -0,0 +1,96 @@
+"""
+    有限体の要素・楕円曲線上の点のメモリ使用量と割り当ての比較
+
+    wallet_appディレクトリで実行する
+    $ python -m benchmarks.memory
+"""
+import random
+import sys
+import time
+import tracemalloc
+
+from crypt import G, N, P, Point, S256Field, S256Point
+
+
+class LegacyFieldElement(object):
+    """ __slots__導入前と同じ__dict__を持つ有限体の要素 """
+    def __init__(self, num, prime):
+        self.num = num
+        self.prime = prime
+
+
+class LegacyPoint(object):
+    """ __slots__導入前と同じ__dict__を持つ点 """
+    def __init__(self, x, y, a, b):
+        self.x = x
+        self.y = y
+        self.a = a
+        self.b = b
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def traced(func):
+    """ funcを実行して(経過時間, 確保されたメモリのピーク)を返す """
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapse = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapse, peak
+
+
+def compare_instances(count):
+    nums = [random.randrange(P) for _ in range(count)]
+    a, b = S256Field(0), S256Field(7)
+    rows = [
+        ('field element (legacy __dict__)',
+         instance_size(LegacyFieldElement(1, P)),
+         traced(lambda: [LegacyFieldElement(n, P) for n in nums])),
+        ('field element (S256Field __slots__)',
+         instance_size(S256Field(1)),
+         traced(lambda: [S256Field._from_int(n) for n in nums])),
+        ('point (legacy __dict__)',
+         instance_size(LegacyPoint(None, None, a, b)),
+         traced(lambda: [LegacyPoint(None, None, a, b) for _ in nums])),
+        ('point (S256Point __slots__)',
+         instance_size(S256Point(None, None)),
+         traced(lambda: [S256Point(None, None) for _ in nums])),
+    ]
+    print(f'{"instances":40}{"bytes/obj":>12}{"sec":>10}{"peak KiB":>12}  (x{count})')
+    for name, size, (elapse, peak) in rows:
+        print(f'{name:40}{size:12}{elapse:10.4f}{peak / 1024:12.1f}')
+
+
+def compare_scalar_mul(count):
+    point = random.randrange(1, N) * G
+    scalars = [random.randrange(1, N) for _ in range(count)]
+    rows = [
+        ('Point.__rmul__ (field objects, affine)',
+         traced(lambda: [Point.__rmul__(point, k) for k in scalars])),
+        ('S256Point.__rmul__ (int, Jacobian+GLV)',
+         traced(lambda: [k * point for k in scalars])),
+    ]
+    print(f'{"scalar multiplication":40}{"ms/op":>12}{"peak KiB":>12}  (x{count})')
+    for name, (elapse, peak) in rows:
+        print(f'{name:40}{elapse / count * 1000:12.3f}{peak / 1024:12.1f}')
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--count', default=100000, type=int,
+                        help='number of instances to allocate')
+    parser.add_argument('--mul_count', default=20, type=int,
+                        help='number of scalar multiplications')
+    args = parser.parse_args()
+
+    compare_instances(args.count)
+    print()
+    compare_scalar_mul(args.mul_count)
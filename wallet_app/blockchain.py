@@ -2,10 +2,12 @@ import contextlib
 import hashlib
 import json
 import logging
+import math
 import sys
 import random
 import time
 import threading
+from unittest import TestCase
 
 # Deleted by 暗号班
 # 楕円曲線暗号と署名検証はスクラッチ実装したので不必要
@@ -13,70 +15,297 @@ import threading
 # from ecdsa import VerifyingKey
 import requests
 
+import codec
+import miner
 import utils
+from mempool import Mempool, transaction_key
+from codec import pack_header
 # Added By 暗号班
 # 公開鍵生成に使用
-from crypt import S256Point
-from crypt import G
-from crypt import N
+from crypt.backend import get_backend
 
 # Added & Deleted By コンセンサス班
 #MINING_DIFFICULTY = 3
-MINING_SENDER = 'THE BLOCKCHAIN'
+MINING_SENDER = codec.MINING_SENDER
 MINING_REWARD = 1.0
 MINING_TIMER_SEC = 20
+# この秒数でナンスが見つからなければ難易度を下げてあきらめる
+POW_TIMEOUT_SEC = 10.0
 
 BLOCKCHAIN_PORT_RANGE = (5000, 5003)
 NEIGHBOURS_IP_RANGE_NUM = (0, 1)
 BLOCKCHAIN_NEIGHBOURS_SYNC_TIME_SEC = 20
 
+# 復元済みの公開鍵を保持しておく件数
+PUBLIC_KEY_CACHE_SIZE = 4096
+# 検証済みの署名を覚えておく件数
+SIGNATURE_CACHE_SIZE = 50000
+# Trueにすると保持しているブロックのハッシュを読むたびに計算し直して確かめる(デバッグ用)
+BLOCK_HASH_DEBUG = False
+
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
 
+def transaction_hash(transaction):
+    """ マークル木の葉 (トランザクションIDと同じ) """
+    return codec.transaction_id(codec.encode_transaction(transaction))
+
+
+def _merkle_parent(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+def merkle_root(hashes):
+    """ 葉のハッシュのリストからマークルルートを求める
+    奇数個の段では最後のノードをそのまま上の段に上げる(複製すると同じルートになる
+    トランザクション列が作れてしまうので複製はしない)．葉がなければ0が32バイト
+    """
+    level = list(hashes)
+    if not level:
+        return bytes(32)
+    while len(level) > 1:
+        parents = [_merkle_parent(level[i], level[i + 1])
+                   for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def merkle_proof(hashes, index):
+    """ hashes[index]がルートに含まれることを示す経路
+    (兄弟ノードのハッシュ, 兄弟が左側か)のリストを葉に近い順に返す
+    """
+    level = list(hashes)
+    proof = []
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append((level[sibling], sibling < index))
+        parents = [_merkle_parent(level[i], level[i + 1])
+                   for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            parents.append(level[-1])
+        level = parents
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf, proof, root):
+    """ 葉のハッシュとmerkle_proofの経路からルートを計算してrootと比べる
+    ライトクライアントはブロックヘッダ(のmerkle_root)だけで包含を確かめられる
+    """
+    node = leaf
+    for sibling, is_left in proof:
+        node = _merkle_parent(sibling, node) if is_left else _merkle_parent(node, sibling)
+    return node == root
+
+
+def block_merkle_root(block):
+    return merkle_root([transaction_hash(t) for t in block['transactions']])
+
+
 class BlockChain(object):
 
-    def __init__(self, blockchain_address=None):
-        self.transaction_pool = []
+    def __init__(self, blockchain_address=None, store=None):
+        """ storeにblockstore.BlockStoreを渡すとブロックを保存し，
+        保存済みのブロックがあればその末尾から再開する
+        """
+        # 未承認トランザクションのプール(mempool.Mempool)
+        self.transaction_pool = Mempool()
         self.chain = []
+        # chainと同じ並びで各ブロックのハッシュを持つ．ブロックを追加した時に1度だけ計算する
+        self.block_hashes = []
+        # チェーン上の残高(アドレス -> 残高)．ブロックを追加するたびに更新する
+        self.balances = {}
         self.difficulty = 3     # Added By コンセンサス
         self.mining_speed = 0.0 # Added By コンセンサス
-        self.create_genesis_block()
+        # ナンス探索に使うプロセス数(0なら自スレッドで探す)と直近のハッシュレート(回/秒)
+        self.mining_processes = 0
+        self.hashrate = 0.0
+        # チェーンの末尾が変わったことをナンス探索に知らせる
+        self.tip_changed = threading.Event()
+        # proof_of_workでナンスを探したブロック(create_blockでナンスを入れて使う)
+        self.mining_template = None
+        self.public_key_cache = utils.LRUCache(PUBLIC_KEY_CACHE_SIZE)
+        self.signature_cache = utils.LRUCache(SIGNATURE_CACHE_SIZE)
+        # 設定されていれば署名の一括検証を別プロセスに任せる(core.signature_verifier)
+        self.signature_verifier = None
+        self.store = store
+        if store is not None and len(store):
+            self.load_store()
+        else:
+            self.create_genesis_block()
         self.blockchain_address = blockchain_address
+
+    def load_store(self):
+        """ 保存済みのブロックを読み込む
+        自分で検証して保存したものなので検証し直さず，ハッシュもインデックスのものを使う
+        """
+        self.chain = list(self.store.blocks())
+        self.block_hashes = self.store.hashes()
+        self.rebuild_balances()
+        logger.info({'action': 'load_store', 'height': len(self.chain) - 1,
+                     'tip': self.block_hashes[-1]})
     
     def create_genesis_block(self):
         print('create_genesis_block is called')
         block = utils.sorted_dict_by_key({
             'timestamp': time.time(),
-            'transactions' : self.transaction_pool,
+            'difficulty': 0,
+            'transactions' : [],
+            'merkle_root': merkle_root([]).hex(),
             'nonce': 0,
-            'previous_hash': self.hash({})
+            'previous_hash': self.hash({}),
+            'version': miner.BLOCK_VERSION
         })
-        self.chain.append(block)
-        self.transaction_pool = []
+        self.append_block(block)
+        self.clear_transaction_pool()
 
     # 共通
     def create_block(self, nonce, previous_hash):
+        """ proof_of_workでナンスを探したブロックにnonceを入れてチェーンに追加する
+        (ヘッダの時刻やトランザクションもナンスを探した時のものを使う)
+        """
         print('create_block is called')
-        block = utils.sorted_dict_by_key({
+        template = self.mining_template
+        if template is None or template['previous_hash'] != previous_hash:
+            template = self.block_template(previous_hash)
+        block = utils.sorted_dict_by_key({**template, 'nonce': nonce})
+
+        if not self.valid_block_proof(block):
+            return False, None
+
+        self.mining_template = None
+        # 残高の変更とプールの更新の間にプールへの追加が割り込まないようにする
+        with self.transaction_pool.lock:
+            self.append_block(block)
+            # ナンスを探している間に届いたトランザクションはプールに残す
+            self.confirm_transactions([block])
+            self.enforce_pool_balances([block])
+
+        return True, block
+
+    def append_block(self, block):
+        """ チェーンの末尾にブロックを追加してハッシュと残高を更新 """
+        self.chain.append(block)
+        self.block_hashes.append(self.hash(block))
+        self.apply_balances(block)
+        if self.store is not None:
+            self.store.append(block, self.block_hashes[-1])
+
+    def blocks_since(self, block_hash, height):
+        """ 高さheightのブロックのハッシュがblock_hashならその後のブロックのリスト
+        自分のチェーンに含まれていなければNone
+        """
+        if 0 <= height < len(self.block_hashes) and self.block_hashes[height] == block_hash:
+            return self.chain[height + 1:]
+        return None
+
+    def extend_chain(self, height, blocks):
+        """ 高さheightから始まるblocksを末尾に続けたチェーンをresolve_conflictsにかける
+        blocks_sinceの返答を受け取った時に使う
+        """
+        if not blocks or height != len(self.chain):
+            return False
+        return self.resolve_conflicts(self.chain + blocks)
+
+    def block_template(self, previous_hash=None):
+        """ プールのトランザクションでナンスを探すためのブロック(nonceは0) """
+        if previous_hash is None:
+            previous_hash = self.last_block_hash()
+        items = self.transaction_pool.block_items()
+        return utils.sorted_dict_by_key({
             'timestamp': time.time(),
             'difficulty': self.difficulty,
-            'transactions': self.transaction_pool,
-            'nonce': nonce,
-            'previous_hash': previous_hash
+            'transactions': [transaction for _, transaction in items],
+            'merkle_root': merkle_root([leaf for leaf, _ in items]).hex(),
+            'nonce': 0,
+            'previous_hash': previous_hash,
+            'version': miner.BLOCK_VERSION
         })
 
-        if not self.valid_proof(block['transactions'],block['previous_hash'], 
-                block['nonce'],block['difficulty']):
-            return False, None
+    def block_hash(self, index):
+        """ 保持しているブロックのハッシュ(ブロックを直列化し直さない) """
+        block_hash = self.block_hashes[index]
+        if BLOCK_HASH_DEBUG:
+            assert block_hash == self.hash(self.chain[index]), index
+        return block_hash
 
-        self.chain.append(block)
-        self.transaction_pool = []
+    def last_block_hash(self):
+        return self.block_hash(-1)
 
-        return True, block
+    def chain_hashes(self, chain):
+        """ chainの各ブロックのハッシュのリスト
+        同じ位置に同じブロックを保持していればそのハッシュを使い，それ以外だけ計算する
+        """
+        hashes = []
+        for i, block in enumerate(chain):
+            if i < len(self.chain) and block == self.chain[i]:
+                hashes.append(self.block_hash(i))
+            else:
+                hashes.append(self.hash(block))
+        return hashes
+
+    def apply_balances(self, block):
+        # calculate_total_amountが全ブロックを走査していた時と同じ順で足し引きする
+        balances = self.balances
+        for transaction in block['transactions']:
+            value = float(transaction['value'])
+            recipient = transaction['recipient_blockchain_address']
+            balances[recipient] = balances.get(recipient, 0.0) + value
+            sender = transaction['sender_blockchain_address']
+            balances[sender] = balances.get(sender, 0.0) - value
+
+    def rebuild_balances(self):
+        self.balances = {}
+        for block in self.chain:
+            self.apply_balances(block)
+
+    def clear_transaction_pool(self):
+        self.transaction_pool.clear()
+
+    def confirm_transactions(self, blocks):
+        """ blocksに入ったトランザクションだけをプールから取り除く """
+        self.transaction_pool.remove(
+            transaction_key(transaction)
+            for block in blocks for transaction in block['transactions'])
+
+    def enforce_pool_balances(self, blocks):
+        """ blocksで残高が変わったアドレスについて，プールの未承認の送金が残高を
+        超えていれば新しいものから取り除く(ブロックの送金で払えなくなったものを残さない)
+        """
+        addresses = [
+            transaction[key]
+            for block in blocks for transaction in block['transactions']
+            for key in ('sender_blockchain_address', 'recipient_blockchain_address')]
+        removed = self.transaction_pool.enforce_balances(
+            addresses, self.calculate_total_amount)
+        if removed:
+            logger.info({'action': 'enforce_pool_balances', 'removed': len(removed)})
+
+    def readmit_transactions(self, orphaned, confirmed):
+        """ チェーンから外れたブロックのトランザクションのうち，新しいチェーンに入って
+        いないものをプールに戻す(採掘の報酬は戻さない)
+        署名はそのブロックを受け入れた時に検証済みなので，残高だけ確かめ直す
+        """
+        confirmed_ids = {
+            transaction_key(transaction)
+            for block in confirmed for transaction in block['transactions']}
+        for block in orphaned:
+            for transaction in block['transactions']:
+                sender = transaction['sender_blockchain_address']
+                if (sender == MINING_SENDER
+                        or transaction_key(transaction) in confirmed_ids):
+                    continue
+                self.add_to_pool(transaction, check_balance=True)
 
     # 共通
     def hash(self, block):
+        """ version 3のブロックはヘッダだけをハッシュする(トランザクションはマークルルートで入る) """
+        if block.get('version') == miner.HEADER_BLOCK_VERSION:
+            return hashlib.sha256(pack_header(block)).hexdigest()
         sorted_block = json.dumps(block, sort_keys=True)
         return hashlib.sha256(sorted_block.encode()).hexdigest()
 
@@ -85,28 +314,89 @@ class BlockChain(object):
                         recipient_blockchain_address, value,
                         sender_public_key=None, signature=None):
         print('add_transaction is called')
-        transaction = utils.sorted_dict_by_key({
-            'sender_blockchain_address': sender_blockchain_address,
-            'recipient_blockchain_address': recipient_blockchain_address,
-            'value': float(value)
-        })
+        # ブロックに入れられる(バイナリ形式にできる)アドレスと金額か確かめる
+        try:
+            value = codec.normalize_amount(value)
+            transaction = utils.sorted_dict_by_key({
+                'sender_blockchain_address': sender_blockchain_address,
+                'recipient_blockchain_address': recipient_blockchain_address,
+                'value': value
+            })
+            codec.encode_transaction(transaction)
+        except ValueError as ex:
+            logger.error({'action': 'add_transaction', 'error': str(ex)})
+            return False
 
         if sender_blockchain_address == MINING_SENDER:
-            self.transaction_pool.append(transaction)
-            return True
+            return self.add_to_pool(transaction)
 
         if self.verify_transaction_signature(
             sender_public_key, signature, transaction):
+            # チェーン受信時に署名を検証し直せるよう公開鍵と署名も残す
+            return self.add_to_pool(
+                self.signed_transaction(transaction, sender_public_key, signature),
+                check_balance=True)
+        return False
 
-            if (self.calculate_total_amount(sender_blockchain_address)
-                    < float(value)):
-                logger.error(
-                        {'action': 'add_transaction', 'error': 'no_value'})
-                return False
+    def add_to_pool(self, transaction, check_balance=False):
+        """ check_balanceならプールにある未承認の送金も合わせて承認済みの残高を超えないか
+        確認する(残高はプールのロックの中で読むので，ブロックの反映と入れ違いにならない)
+        """
+        balance = self.calculate_total_amount if check_balance else None
+        try:
+            self.transaction_pool.add(transaction, balance)
+        except ValueError as ex:
+            logger.error({'action': 'add_transaction', 'error': str(ex)})
+            return False
+        return True
 
-            self.transaction_pool.append(transaction)
-            return True
-        return False
+    def signed_transaction(self, transaction, sender_public_key, signature):
+        return utils.sorted_dict_by_key({
+            **transaction,
+            'sender_public_key': sender_public_key,
+            'signature': [signature[0], signature[1]]
+        })
+
+    def transaction_digest(self, transaction):
+        """ 署名対象のハッシュ値(int)
+        署名はsender, recipient, valueの3項目をバイナリ形式にしたものに対して行われている
+        """
+        return codec.signing_digest(
+            transaction['sender_blockchain_address'],
+            transaction['recipient_blockchain_address'],
+            transaction['value'])
+
+    def load_public_key(self, sender_public_key):
+        """ 文字列から検証用の公開鍵を再構築
+        同じ送金者が何度も送ってくるので，曲線上の点かの確認や
+        スカラー倍用の表の作成を毎回しないようキャッシュする
+        不正な公開鍵ならNone
+        """
+        backend = get_backend()
+        cache_key = (backend.name, sender_public_key)
+        key = self.public_key_cache.get(cache_key)
+        if key is None:
+            public_key = self.parse_public_key(sender_public_key)
+            if public_key is None:
+                return None
+            try:
+                key = backend.load_public_key(public_key)
+            except ValueError:
+                return None
+            self.public_key_cache.put(cache_key, key)
+        return key
+
+    def parse_public_key(self, sender_public_key):
+        """ 文字列から公開鍵(x, y)を取り出す．形式が不正ならNone """
+        try:
+            return (int(sender_public_key[:64], 16),
+                    int(sender_public_key[64:], 16))
+        except (TypeError, ValueError):
+            return None
+
+    def signature_cache_key(self, transaction, sender_public_key, signature):
+        return (self.transaction_digest(transaction), sender_public_key,
+                signature[0], signature[1])
 
     
     # Changed By 暗号班
@@ -116,31 +406,68 @@ class BlockChain(object):
         esdsaの内部で行なっていた計算をここで行っているイメージ
         返り値はbool型
         """
-        sha256 = hashlib.sha256()
-        sha256.update(str(transaction).encode('utf-8'))
-        message = sha256.digest()
-        msg_hex = message.hex()
-        msg_hex_str = str(msg_hex)
-        msg_hex_str_0x = '0x' + msg_hex_str
-        z = int(msg_hex_str_0x, 0)
-        s_inv = pow(signature[1], N - 2, N)
-        # u = z / s
-        # v = r / s
-        u = (z * s_inv) % N
-        v = (signature[0] * s_inv) % N
-
-        # 文字列から公開鍵を再構築
-        x = '0x' + sender_public_key[:64]
-        y = '0x' + sender_public_key[64:]
-        x = int(x, 0)
-        y = int(y, 0)
-        P = S256Point(x, y)
-        total = u * G + v * P
-        return total.x.num == signature[0]
+        cache_key = self.signature_cache_key(
+            transaction, sender_public_key, signature)
+        if self.signature_cache.get(cache_key):
+            return True
+        key = self.load_public_key(sender_public_key)
+        if key is None:
+            return False
+        z, _, r, s = cache_key
+        is_valid = get_backend().verify(key, z, r, s)
+        if is_valid:
+            self.signature_cache.put(cache_key, True)
+        return is_valid
+
+    def verify_transaction_signatures(self, transactions):
+        """ 署名付きトランザクションの一括検証
+        ブロック検証やトランザクションプールへのまとめての追加で使う
+        マイニング報酬以外で署名のないものは不正とみなす
+        プールに入れた時に検証済みのものは楕円曲線の計算をせずに済ませる
+        返り値はtransactionsと同じ順のboolのリスト
+        """
+        results = [True] * len(transactions)
+        items = []
+        indices = []
+        cache_keys = []
+        for i, transaction in enumerate(transactions):
+            if transaction['sender_blockchain_address'] == MINING_SENDER:
+                continue
+            if 'signature' not in transaction:
+                results[i] = False
+                continue
+            cache_key = self.signature_cache_key(
+                transaction, transaction['sender_public_key'],
+                transaction['signature'])
+            if self.signature_cache.get(cache_key):
+                continue
+            if self.signature_verifier is not None:
+                key = self.parse_public_key(transaction['sender_public_key'])
+            else:
+                key = self.load_public_key(transaction['sender_public_key'])
+            if key is None:
+                results[i] = False
+                continue
+            z, _, r, s = cache_key
+            items.append((key, z, r, s))
+            indices.append(i)
+            cache_keys.append(cache_key)
+        if self.signature_verifier is not None:
+            verified = self.signature_verifier.verify_many(items)
+        else:
+            verified = get_backend().verify_many(items)
+        for i, cache_key, is_valid in zip(indices, cache_keys, verified):
+            results[i] = is_valid
+            if is_valid:
+                self.signature_cache.put(cache_key, True)
+        return results
 
     # Added By コンセンサス
     # 採掘難易度の調整
-    def difficulty_adjustment(self, speed):
+    def difficulty_adjustment(self, speed, hashrate=None):
+        """ hashrateを渡すと，POW_TIMEOUT_SEC以内に解ける見込みのある難易度までに抑える """
+        if hashrate:
+            self.hashrate = hashrate
         if self.difficulty < 3:
             self.difficulty = 3
             return True
@@ -156,32 +483,60 @@ class BlockChain(object):
                 self.mining_speed = speed + random.uniform(4.4, 4.7)
                 if self.mining_speed >= 5.5:
                     self.mining_speed -= random.uniform(0.5, 1.0)
-            logger.info({'action': 'changing difficulty', 'status': 'success'})
+            if hashrate:
+                # 難易度dで必要な試行回数の期待値は16^d
+                max_difficulty = max(
+                    3, int(math.log(hashrate * POW_TIMEOUT_SEC, 16)))
+                self.difficulty = min(self.difficulty, max_difficulty)
+            logger.info({'action': 'changing difficulty', 'status': 'success',
+                         'difficulty': self.difficulty, 'hashrate': self.hashrate})
             return True
         
-    # Changed By コンセンサス
-    def valid_proof(self, transactions, previous_hash, nonce, difficulty):
-        guess_block = utils.sorted_dict_by_key({
-            'transactions': transactions,
-            'nonce': nonce,
-            'previous_hash': previous_hash
-        })
-        guess_hash = self.hash(guess_block)
-        print('guess_hash', guess_hash)
-        return guess_hash[:difficulty] == '0'*difficulty
+    def valid_block_proof(self, block):
+        """ マークルルートがトランザクションと合うかとヘッダのproofを確かめる
+        (version 3以外のブロックはバイナリ形式にできず受け取ることもないので不正とする)
+        """
+        if block.get('version') != miner.HEADER_BLOCK_VERSION:
+            return False
+        if block['merkle_root'] != block_merkle_root(block).hex():
+            return False
+        return miner.valid_header_proof(
+            pack_header(block), block['difficulty'])
 
     # Changed By コンセンサス
     def proof_of_work(self):
-        transactions = self.transaction_pool.copy()
-        previous_hash = self.hash(self.chain[-1])
-        nonce = 0
+        """ mining_processesが1より多ければ複数プロセスでナンスを探す
+        試したナンスの数からハッシュレートを求めてself.hashrateに残す
+        探索中にチェーンの末尾が変わったら(tip_changed)，古いprevious_hashでの探索をやめて
+        新しい末尾でトランザクションとprevious_hashを取り直して探し直す
+        """
         start = time.time()
-        while self.valid_proof(transactions, previous_hash, nonce, self.difficulty) is False:
-            nonce += 1
-            elapse = time.time() - start
-            if elapse >= 10.0:
-                self.difficulty -= 1
-                return -1
+        total_attempts = 0
+        while True:
+            self.tip_changed.clear()
+            template = self.block_template()
+            prefix = pack_header(template)[:-miner.NONCE_SIZE]
+            if self.mining_processes > 1:
+                nonce, attempts = miner.parallel_search_nonce(
+                    prefix, template['difficulty'], self.mining_processes,
+                    timeout=POW_TIMEOUT_SEC, cancel=self.tip_changed)
+            else:
+                nonce, attempts = miner.search_nonce(
+                    prefix, template['difficulty'],
+                    timeout=POW_TIMEOUT_SEC, cancel=self.tip_changed)
+            total_attempts += attempts
+            if nonce == -1 and self.tip_changed.is_set():
+                logger.info({'action': 'proof_of_work', 'status': 'restart',
+                             'previous_hash': self.last_block_hash()})
+                continue
+            break
+        elapse = time.time() - start
+        if elapse > 0:
+            self.hashrate = total_attempts / elapse
+        if nonce == -1:
+            self.difficulty -= 1
+        else:
+            self.mining_template = template
         return nonce
 
 
@@ -197,7 +552,7 @@ class BlockChain(object):
         nonce = self.proof_of_work()
         if nonce == -1:
             return False
-        previous_hash = self.hash(self.chain[-1])
+        previous_hash = self.last_block_hash()
         self.create_block(nonce, previous_hash)
         logger.info({'action': 'mining', 'status': 'success'})
 
@@ -205,7 +560,7 @@ class BlockChain(object):
         callback()
 
         elapse = round(time.time() - start, 4)
-        self.difficulty_adjustment(elapse)
+        self.difficulty_adjustment(elapse, self.hashrate)
 
         # print('mining speed : ', str(round(self.mining_speed, 3)))
         # print('difficult : ', str(self.difficulty))
@@ -225,44 +580,148 @@ class BlockChain(object):
 
     # 共通
     def calculate_total_amount(self, blockchain_address):
-        total_amount = 0.0
-        for block in self.chain:
-            for transaction in block['transactions']:
-                value = float(transaction['value'])
-                if blockchain_address == transaction['recipient_blockchain_address']:
-                    total_amount += value
-                if blockchain_address == transaction['sender_blockchain_address']:
-                    total_amount -= value
-        return total_amount
+        """ チェーン上で承認済みの残高 """
+        return self.balances.get(blockchain_address, 0.0)
+
+    def calculate_available_amount(self, blockchain_address):
+        """ 承認済みの残高からプールにある未承認の送金額を引いたもの """
+        return (self.calculate_total_amount(blockchain_address)
+                - self.transaction_pool.pending_debit(blockchain_address))
 
     # Chaged By コンセンサス
-    def valid_chain(self, chain):
-        pre_block = chain[0]
+    def valid_chain(self, chain, hashes=None):
+        """ hashesにはchain_hashes(chain)の結果を渡せる(なければここで求める)
+        自分が同じ位置に持っているのと同じブロックは検証済みなので，
+        ハッシュを計算し直さず，proofと署名の検証もしない
+        """
+        if hashes is None:
+            hashes = self.chain_hashes(chain)
+        held = self.fork_height(chain, hashes)
         current_index = 1
         while current_index < len(chain):
             block = chain[current_index]
-            if block['previous_hash'] != self.hash(pre_block):
+            if block['previous_hash'] != hashes[current_index - 1]:
                 print('hash conflict')
                 return False
-            print('block', block)
-            if not self.valid_proof(
-                block['transactions'], block['previous_hash'],
-                block['nonce'], block['difficulty']):
-                print(' proof conflict')
-                return False
+            if current_index >= held:
+                print('block', block)
+                if not self.valid_block_proof(block):
+                    print(' proof conflict')
+                    return False
 
-            pre_block = block
             current_index += 1
+
+        # 新しいブロックのトランザクションの署名をまとめて検証
+        transactions = [
+            transaction for block in chain[max(held, 1):]
+            for transaction in block['transactions']]
+        if not all(self.verify_transaction_signatures(transactions)):
+            print('signature conflict')
+            return False
         return True
 
+    def fork_height(self, chain, hashes):
+        """ chain(ハッシュはhashes)のうち自分と同じブロックが続く先頭部分の長さ """
+        # version 3のハッシュはヘッダだけなので，トランザクションまで同じかも比べる
+        held = 0
+        while (held < len(chain) and held < len(self.chain)
+               and hashes[held] == self.block_hashes[held]
+               and chain[held] == self.chain[held]):
+            held += 1
+        return held
+
+    def save_chain(self, chain, hashes, common):
+        """ 保存済みのブロックのうち高さcommon以降を捨ててchainの残りを追加する """
+        self.store.truncate(common)
+        for block, block_hash in zip(chain[common:], hashes[common:]):
+            self.store.append(block, block_hash)
+
     def resolve_conflicts(self, chain):
         mychain_len = len(self.chain)
         newchain_len = len(chain)
-        print('valid_chain: ',self.valid_chain(chain))
-        if newchain_len > mychain_len and self.valid_chain(chain):
-            self.chain = chain
+        hashes = self.chain_hashes(chain)
+        is_valid = self.valid_chain(chain, hashes)
+        print('valid_chain: ', is_valid)
+        if newchain_len > mychain_len and is_valid:
+            # 残高の変更とプールの更新の間にプールへの追加が割り込まないようにする
+            with self.transaction_pool.lock:
+                common = self.fork_height(chain, hashes)
+                orphaned = self.chain[common:]
+                if self.store is not None:
+                    self.save_chain(chain, hashes, common)
+                self.chain = chain
+                self.block_hashes = hashes
+                self.tip_changed.set()
+                # 自分のチェーンをそのまま伸ばしたものなら追加分だけ残高に反映する
+                if orphaned:
+                    self.rebuild_balances()
+                else:
+                    for block in chain[common:]:
+                        self.apply_balances(block)
+                # 新しく入ったブロックのトランザクションだけをプールから除き，
+                # 外れたブロックのトランザクションはプールに戻す
+                self.confirm_transactions(chain[common:])
+                self.readmit_transactions(orphaned, chain[common:])
+                self.enforce_pool_balances(chain[common:] + orphaned)
             logger.info({'action': 'resolve_conflicts', 'status':'replaced'})
             return True
         
         logger.info({'action': 'resolve_conflicts', 'status': 'not_replaced'})
         return False
+
+
+class BlockChainTest(TestCase):
+
+    def setUp(self):
+        # walletはテストでだけ使うので，blockchainを読み込むだけでは読み込まない
+        from wallet import Wallet
+        self.sender, self.x, self.y = Wallet(), Wallet(), Wallet()
+        self.node = self.mined_chain(self.sender.blockchain_address)
+        self.peer = BlockChain(self.x.blockchain_address)
+        self.peer.difficulty = 1
+        self.peer.resolve_conflicts(list(self.node.chain))
+
+    def mined_chain(self, miner_address):
+        """ miner_addressが報酬(MINING_REWARD)を受け取ったブロックを持つチェーン """
+        chain = BlockChain(miner_address)
+        chain.difficulty = 1
+        self.mine(chain)
+        return chain
+
+    def mine(self, chain):
+        chain.add_transaction(MINING_SENDER, chain.blockchain_address, MINING_REWARD)
+        nonce = chain.proof_of_work()
+        self.assertTrue(chain.create_block(nonce, chain.last_block_hash())[0])
+
+    def pay(self, chain, recipient, value):
+        from wallet import Transaction
+        transaction = Transaction(
+            self.sender.private_key, self.sender.public_key,
+            self.sender.blockchain_address, recipient.blockchain_address, value)
+        return chain.add_transaction(
+            self.sender.blockchain_address, recipient.blockchain_address, value,
+            self.sender.public_key, transaction.signature)
+
+    def test_evict_overspend_after_peer_block(self):
+        address = self.sender.blockchain_address
+        self.assertEqual(self.node.calculate_total_amount(address), MINING_REWARD)
+        self.assertTrue(self.pay(self.node, self.y, MINING_REWARD))
+        # 同じ残高を別の宛先に使ったブロックを受け取る
+        self.assertTrue(self.pay(self.peer, self.x, MINING_REWARD))
+        self.mine(self.peer)
+        self.assertTrue(self.node.resolve_conflicts(list(self.peer.chain)))
+        self.assertEqual(self.node.calculate_available_amount(address), 0.0)
+        recipients = [t['recipient_blockchain_address']
+                      for t in self.node.block_template()['transactions']]
+        self.assertNotIn(self.y.blockchain_address, recipients)
+
+    def test_readmit_orphaned_within_balance(self):
+        address = self.sender.blockchain_address
+        self.assertTrue(self.pay(self.node, self.y, 0.5))
+        self.node.blockchain_address = self.y.blockchain_address
+        self.mine(self.node)
+        self.mine(self.peer)
+        self.mine(self.peer)
+        self.assertTrue(self.node.resolve_conflicts(list(self.peer.chain)))
+        self.assertEqual(self.node.transaction_pool.pending_debit(address), 0.5)
+        self.assertEqual(self.node.calculate_available_amount(address), 0.5)
@@ -0,0 +1,319 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import codec
+
+""" ブロックの追記専用ストア
+
+ディレクトリにブロックの本体(blocks.dat)とインデックス(blocks.idx)を置く
+blocks.dat  (長さ(4) + codec.encode_blockのバイト列)の繰り返し
+blocks.idx  高さの順に(blocks.datでの位置(8), 長さ(4), ブロックのハッシュ(32))の繰り返し
+読み出しはblocks.datをmmapして行う
+ピアへの送信はfile_rangeでblocks.datの範囲を求め，sendfileでそのまま送る
+    truncateはblocks.datを書き換えずに残す部分を新しいファイルにしてos.replaceで差し替えるので，
+    file_rangeで開いたファイルを送っている間に同じ位置が別のブロックで上書きされることはない
+書き込みは毎回fsyncせず，FSYNC_BATCH_SIZE個またはFSYNC_INTERVAL_SEC秒ごとにまとめて行う
+(落ちた時に失うのは最後の数ブロックだけで，それはピアから取り直す)
+開く時にはインデックスとblocks.datを突き合わせ，途中で切れたレコードを捨てる
+"""
+
+DATA_FILE = 'blocks.dat'
+INDEX_FILE = 'blocks.idx'
+# この数のブロックを追加するごとにfsyncする
+FSYNC_BATCH_SIZE = 16
+# 前回のfsyncからこの秒数が過ぎていれば追加の時にfsyncする
+FSYNC_INTERVAL_SEC = 1.0
+
+_RECORD_LENGTH = struct.Struct('>I')
+_INDEX_ENTRY = struct.Struct('>QI32s')
+
+
+class BlockStore(object):
+
+    def __init__(self, directory, sync_every=FSYNC_BATCH_SIZE,
+                 sync_interval=FSYNC_INTERVAL_SEC):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._lock = threading.RLock()
+        self.data_path = os.path.join(directory, DATA_FILE)
+        self._data = open(self.data_path, 'a+b')
+        self._index = open(os.path.join(directory, INDEX_FILE), 'a+b')
+        # 高さの順の(位置, 長さ)とハッシュ(hex)，ハッシュ -> 高さ
+        self._entries = []
+        self._hashes = []
+        self._heights = {}
+        self._mmap = None
+        self._pending = 0
+        self._last_sync = time.time()
+        self._recover()
+
+    def _recover(self):
+        """ インデックスを読み込み，blocks.datと合わない部分を直す """
+        self._index.seek(0)
+        raw = self._index.read()
+        data_size = os.fstat(self._data.fileno()).st_size
+        end = 0
+        count = len(raw) // _INDEX_ENTRY.size
+        for i in range(count):
+            offset, length, block_hash = _INDEX_ENTRY.unpack_from(raw, i * _INDEX_ENTRY.size)
+            if offset != end or offset + _RECORD_LENGTH.size + length > data_size:
+                break
+            self._add_entry(offset, length, block_hash.hex())
+            end = offset + _RECORD_LENGTH.size + length
+        if len(self._entries) * _INDEX_ENTRY.size != len(raw):
+            self._index.truncate(len(self._entries) * _INDEX_ENTRY.size)
+        # インデックスに載る前に落ちたレコードを拾う
+        self._remap(data_size)
+        while end + _RECORD_LENGTH.size <= data_size:
+            (length,) = _RECORD_LENGTH.unpack_from(self._mmap, end)
+            start = end + _RECORD_LENGTH.size
+            if start + length > data_size or length < codec.BLOCK_HEADER_SIZE:
+                break
+            block_hash = hashlib.sha256(
+                self._mmap[start:start + codec.BLOCK_HEADER_SIZE]).hexdigest()
+            self._add_entry(end, length, block_hash)
+            self._index.write(_INDEX_ENTRY.pack(end, length, bytes.fromhex(block_hash)))
+            end = start + length
+        if end != data_size:
+            self._mmap = None
+            self._data.truncate(end)
+        self.sync()
+
+    def _add_entry(self, offset, length, block_hash):
+        self._heights[block_hash] = len(self._entries)
+        self._entries.append((offset, length))
+        self._hashes.append(block_hash)
+
+    def _remap(self, size=None):
+        if size is None:
+            size = os.fstat(self._data.fileno()).st_size
+        # 古いmmapは読み出し中のmemoryviewが残っていても使えるよう閉じずに手放す
+        self._mmap = mmap.mmap(self._data.fileno(), size,
+                               access=mmap.ACCESS_READ) if size else None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def tip(self):
+        """ (高さ, ハッシュ)．空ならNone """
+        if not self._entries:
+            return None
+        return len(self._entries) - 1, self._hashes[-1]
+
+    def hash_at(self, height):
+        return self._hashes[height]
+
+    def hashes(self):
+        return list(self._hashes)
+
+    def height_of(self, block_hash):
+        return self._heights.get(block_hash)
+
+    def read(self, height):
+        """ 高さheightのブロックのバイト列(mmapのmemoryview) """
+        offset, length = self._entries[height]
+        start = offset + _RECORD_LENGTH.size
+        with self._lock:
+            if self._mmap is None or len(self._mmap) < start + length:
+                self._data.flush()
+                self._remap()
+            return memoryview(self._mmap)[start:start + length]
+
+    def file_range(self, start=0):
+        """ 高さstart以降のブロックのレコードが並ぶblocks.datの範囲
+        (ブロック数, (ファイル, 位置, 長さ))を返す．レコードはcodecのチェーンの要素と同じ形式
+        ファイルはロックの中で開いたもので，呼び出し側が閉じる．ブロックがなければ(0, None)
+        """
+        with self._lock:
+            self._data.flush()
+            count = max(len(self._entries) - start, 0)
+            if not count:
+                return 0, None
+            offset, _ = self._entries[start]
+            last_offset, last_length = self._entries[-1]
+            end = last_offset + _RECORD_LENGTH.size + last_length
+            return count, (open(self.data_path, 'rb'), offset, end - offset)
+
+    def block(self, height):
+        return codec.decode_block(self.read(height))
+
+    def blocks(self, start=0):
+        for height in range(start, len(self._entries)):
+            yield self.block(height)
+
+    def append(self, block, block_hash):
+        """ ブロックを末尾に追加する(fsyncはまとめて行う) """
+        data = codec.encode_block(block)
+        with self._lock:
+            self._data.seek(0, os.SEEK_END)
+            offset = self._data.tell()
+            self._data.write(_RECORD_LENGTH.pack(len(data)) + data)
+            self._index.write(_INDEX_ENTRY.pack(offset, len(data), bytes.fromhex(block_hash)))
+            self._add_entry(offset, len(data), block_hash)
+            self._pending += 1
+            if (self._pending >= self.sync_every
+                    or time.time() - self._last_sync >= self.sync_interval):
+                self.sync()
+
+    def truncate(self, height):
+        """ 高さheight以降のブロックを捨てる(チェーンが置き換わった時に使う) """
+        with self._lock:
+            if height >= len(self._entries):
+                return
+            offset, _ = self._entries[height]
+            for block_hash in self._hashes[height:]:
+                del self._heights[block_hash]
+            del self._entries[height:]
+            del self._hashes[height:]
+            self._data.flush()
+            self._index.flush()
+            # 送信中のファイルは古い方を読み続ける
+            self._remap()
+            temp_path = self.data_path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                if offset:
+                    f.write(memoryview(self._mmap)[:offset])
+                f.flush()
+                os.fsync(f.fileno())
+            self._mmap = None
+            self._data.close()
+            os.replace(temp_path, self.data_path)
+            self._data = open(self.data_path, 'a+b')
+            self._index.truncate(height * _INDEX_ENTRY.size)
+            self.sync()
+
+    def sync(self):
+        """ 本体を先にfsyncしてからインデックスをfsyncする """
+        with self._lock:
+            self._data.flush()
+            os.fsync(self._data.fileno())
+            self._index.flush()
+            os.fsync(self._index.fileno())
+            self._pending = 0
+            self._last_sync = time.time()
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self._mmap = None
+            self._data.close()
+            self._index.close()
+
+
+class BlockStoreTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+        self.store = BlockStore(self.directory)
+        self.blocks = [self.block(i) for i in range(3)]
+        for block in self.blocks:
+            self.store.append(block, self.hash(block))
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def block(self, nonce):
+        recipient = codec.encode_address_string(bytes([nonce + 1]) * codec.ADDRESS_SIZE)
+        return {
+            'timestamp': 1600000000.0 + nonce,
+            'difficulty': 0,
+            'transactions': [{
+                'sender_blockchain_address': codec.MINING_SENDER,
+                'recipient_blockchain_address': recipient,
+                'value': 1.0
+            }],
+            'merkle_root': '00' * 32,
+            'nonce': nonce,
+            'previous_hash': '00' * 32,
+            'version': codec.HEADER_BLOCK_VERSION
+        }
+
+    def hash(self, block):
+        return hashlib.sha256(codec.pack_header(block)).hexdigest()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def reopen(self):
+        self.store.close()
+        self.store = BlockStore(self.directory)
+        return self.store
+
+    def assertHolds(self, blocks):
+        self.assertEqual(len(self.store), len(blocks))
+        self.assertEqual(list(self.store.blocks()), blocks)
+        self.assertEqual(self.store.hashes(), [self.hash(b) for b in blocks])
+        if blocks:
+            self.assertEqual(self.store.tip(), (len(blocks) - 1, self.hash(blocks[-1])))
+        # インデックスと本体が直った状態で保存されている
+        self.store.sync()
+        self.assertEqual(os.path.getsize(self.path(INDEX_FILE)),
+                         len(blocks) * _INDEX_ENTRY.size)
+        self.assertEqual(os.path.getsize(self.path(DATA_FILE)),
+                         sum(_RECORD_LENGTH.size + len(codec.encode_block(b)) for b in blocks))
+
+    def test_reopen(self):
+        self.reopen()
+        self.assertHolds(self.blocks)
+        self.assertEqual(self.store.height_of(self.hash(self.blocks[1])), 1)
+
+    def test_torn_tail(self):
+        # 書き込み途中で落ちたレコード(長さだけ書かれて本体が足りない)を捨てる
+        self.store.close()
+        with open(self.path(DATA_FILE), 'ab') as f:
+            f.write(_RECORD_LENGTH.pack(500) + b'\x00' * 10)
+        self.store = BlockStore(self.directory)
+        self.assertHolds(self.blocks)
+
+    def test_stale_index(self):
+        # 本体が短くなっていれば，インデックスのそれより先のエントリを捨てる
+        size = _RECORD_LENGTH.size + len(codec.encode_block(self.blocks[0]))
+        self.store.close()
+        with open(self.path(DATA_FILE), 'r+b') as f:
+            f.truncate(size + 5)
+        self.store = BlockStore(self.directory)
+        self.assertHolds(self.blocks[:1])
+
+    def test_reindex_missing(self):
+        # インデックスに載る前に落ちたレコードは本体から読み直して索引する
+        self.store.close()
+        with open(self.path(INDEX_FILE), 'r+b') as f:
+            f.truncate(_INDEX_ENTRY.size + 7)
+        self.store = BlockStore(self.directory)
+        self.assertHolds(self.blocks)
+
+    def test_truncate(self):
+        other = self.block(9)
+        self.store.truncate(1)
+        self.store.append(other, self.hash(other))
+        self.assertIsNone(self.store.height_of(self.hash(self.blocks[2])))
+        self.assertHolds([self.blocks[0], other])
+        self.reopen()
+        self.assertHolds([self.blocks[0], other])
+        self.store.truncate(0)
+        self.assertHolds([])
+        self.assertIsNone(self.store.tip())
+        self.assertEqual(self.store.file_range(), (0, None))
+
+    def test_file_range_survives_truncate(self):
+        count, (f, offset, length) = self.store.file_range(1)
+        with f:
+            self.assertEqual(count, 2)
+            # 送信中に置き換わったブロックが同じ位置に書かれても開いた方は元のまま
+            other = self.block(9)
+            self.store.truncate(1)
+            self.store.append(other, self.hash(other))
+            f.seek(offset)
+            chain = codec.decode_chain(codec.chain_prefix(count) + f.read(length))
+        self.assertEqual(chain, self.blocks[1:])
+        self.assertHolds([self.blocks[0], other])
@@ -0,0 +1,366 @@
+import hashlib
+import json
+import math
+import struct
+from unittest import TestCase
+
+import utils
+from crypt import decode_base58, encode_base58_checksum
+from miner import HEADER_BLOCK_VERSION
+
+""" トランザクション・ブロックのバイナリ形式
+
+JSONの代わりにハッシュ計算・保存・通信で使う固定レイアウトの形式
+デバッグ用にはdecodeした辞書(debug_jsonでJSON文字列)を見る
+
+トランザクション (TX_VERSION = 1)
+    version(1) | flags(1) | [送金者のhash160(20)] | 受取人のhash160(20) | 金額(8)
+    | [公開鍵(長さ1 + 本体) | r(長さ1 + 本体) | s(長さ1 + 本体)]
+    flagsのTX_COINBASEが立っていれば送金者はMINING_SENDERで，送金者のフィールドはない
+    flagsのTX_SIGNEDが立っていれば公開鍵と署名が続く
+    アドレスはBase58Checkを外した20バイト，金額はAMOUNT_UNIT倍した整数
+ブロック (ヘッダのversionが3のもの)
+    ヘッダ(BLOCK_HEADER_FORMATの88バイト) | トランザクション数(4)
+    | (長さ(4) + トランザクション)の繰り返し
+チェーン
+    ブロック数(4) | (長さ(4) + ブロック)の繰り返し
+    (長さ(4) + ブロック)はblockstoreのblocks.datのレコードと同じなので，保存済みの部分は
+    ファイルのバイト列をそのまま送れる
+途中からのブロック(RSP_BLOCKS)
+    最初のブロックの高さ(8) | チェーン
+整数はすべてビッグエンディアン
+"""
+
+MINING_SENDER = 'THE BLOCKCHAIN'
+
+TX_VERSION = 1
+TX_COINBASE = 0x01
+TX_SIGNED = 0x02
+# 金額の最小単位 (1.0 = AMOUNT_UNIT)
+AMOUNT_UNIT = 10 ** 8
+ADDRESS_PREFIX = b'\x00'
+ADDRESS_SIZE = 20
+
+# ブロックヘッダ(version 3): version, previous_hash, merkle_root, timestamp, difficulty, nonce
+# ナンスはmidstateを使えるよう末尾に置く(miner.NONCE_SIZEバイト)
+BLOCK_HEADER_FORMAT = '>I32s32sdiQ'
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_HEADER_FORMAT)
+
+_TX_PREFIX = struct.Struct('>BB')
+_AMOUNT = struct.Struct('>Q')
+_LENGTH = struct.Struct('>I')
+_HEIGHT = struct.Struct('>Q')
+
+
+def to_units(value):
+    """ 金額(float)を最小単位の整数にする．負の値や大きすぎる値，inf・nanはValueError """
+    try:
+        value = float(value)
+    except TypeError as e:
+        raise ValueError(f'bad amount: {value!r}') from e
+    if not math.isfinite(value):
+        raise ValueError(f'amount out of range: {value}')
+    units = int(round(value * AMOUNT_UNIT))
+    if not 0 <= units < 1 << 64:
+        raise ValueError(f'amount out of range: {value}')
+    return units
+
+
+def from_units(units):
+    return units / AMOUNT_UNIT
+
+
+def normalize_amount(value):
+    """ バイナリ形式を通しても変わらない金額にそろえる """
+    return from_units(to_units(value))
+
+
+def encode_address(address):
+    """ Base58Checkのアドレスを20バイトのhash160にする """
+    try:
+        h160 = decode_base58(address)
+    except (ValueError, OverflowError, TypeError) as e:
+        raise ValueError(f'bad address: {address}') from e
+    if encode_address_string(h160) != address:
+        raise ValueError(f'unsupported address: {address}')
+    return h160
+
+
+def encode_address_string(h160):
+    return encode_base58_checksum(ADDRESS_PREFIX + h160)
+
+
+def _length_prefixed(data):
+    if len(data) > 0xff:
+        raise ValueError('field too long')
+    return bytes([len(data)]) + data
+
+
+def _int_field(value):
+    return _length_prefixed(value.to_bytes((value.bit_length() + 7) // 8, 'big'))
+
+
+def _encode_public_key(public_key):
+    try:
+        data = bytes.fromhex(public_key)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'bad public key: {public_key}') from e
+    if data.hex() != public_key:
+        raise ValueError(f'bad public key: {public_key}')
+    return _length_prefixed(data)
+
+
+def encode_transaction(transaction, signed=True):
+    """ トランザクションの辞書をバイナリにする
+    signed=Falseでは公開鍵と署名を除いた部分(署名の対象)だけにする
+    """
+    sender = transaction['sender_blockchain_address']
+    flags = 0
+    if sender == MINING_SENDER:
+        flags |= TX_COINBASE
+    if signed and 'signature' in transaction:
+        flags |= TX_SIGNED
+    parts = [_TX_PREFIX.pack(TX_VERSION, flags)]
+    if not flags & TX_COINBASE:
+        parts.append(encode_address(sender))
+    parts.append(encode_address(transaction['recipient_blockchain_address']))
+    parts.append(_AMOUNT.pack(to_units(transaction['value'])))
+    if flags & TX_SIGNED:
+        r, s = transaction['signature']
+        parts.append(_encode_public_key(transaction['sender_public_key']))
+        parts.append(_int_field(r))
+        parts.append(_int_field(s))
+    return b''.join(parts)
+
+
+def signing_digest(sender_blockchain_address, recipient_blockchain_address, value):
+    """ 署名するハッシュ値(int)．公開鍵と署名を除いたトランザクションのsha256 """
+    data = encode_transaction({
+        'sender_blockchain_address': sender_blockchain_address,
+        'recipient_blockchain_address': recipient_blockchain_address,
+        'value': value
+    }, signed=False)
+    return int.from_bytes(hashlib.sha256(data).digest(), 'big')
+
+
+def transaction_id(data):
+    """ encode_transactionのバイト列からトランザクションID(32バイト)を求める
+    マークル木の葉と同じで，内部ノードと区別するため先頭に0x00をつけてハッシュする
+    """
+    return hashlib.sha256(b'\x00' + data).digest()
+
+
+class _Reader(object):
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def read(self, size):
+        end = self.offset + size
+        if end > len(self.data):
+            raise ValueError('truncated data')
+        chunk = bytes(self.data[self.offset:end])
+        self.offset = end
+        return chunk
+
+    def unpack(self, fmt):
+        values = fmt.unpack(self.read(fmt.size))
+        return values if len(values) > 1 else values[0]
+
+    def read_prefixed(self):
+        return self.read(self.read(1)[0])
+
+    def read_chunk(self):
+        return self.read(self.unpack(_LENGTH))
+
+    def finish(self):
+        if self.offset != len(self.data):
+            raise ValueError('trailing data')
+
+
+def _decode_transaction(reader):
+    version, flags = reader.unpack(_TX_PREFIX)
+    if version != TX_VERSION:
+        raise ValueError(f'unknown transaction version: {version}')
+    if flags & TX_COINBASE:
+        sender = MINING_SENDER
+    else:
+        sender = encode_address_string(reader.read(ADDRESS_SIZE))
+    transaction = {
+        'sender_blockchain_address': sender,
+        'recipient_blockchain_address': encode_address_string(reader.read(ADDRESS_SIZE)),
+        'value': from_units(reader.unpack(_AMOUNT))
+    }
+    if flags & TX_SIGNED:
+        transaction['sender_public_key'] = reader.read_prefixed().hex()
+        transaction['signature'] = [int.from_bytes(reader.read_prefixed(), 'big'),
+                                    int.from_bytes(reader.read_prefixed(), 'big')]
+    return utils.sorted_dict_by_key(transaction)
+
+
+def decode_transaction(data):
+    reader = _Reader(data)
+    transaction = _decode_transaction(reader)
+    reader.finish()
+    return transaction
+
+
+def pack_header(block):
+    """ version 3のブロックのヘッダをBLOCK_HEADER_SIZEバイトに詰める """
+    return struct.pack(
+        BLOCK_HEADER_FORMAT,
+        block['version'],
+        bytes.fromhex(block['previous_hash']),
+        bytes.fromhex(block['merkle_root']),
+        block['timestamp'],
+        block['difficulty'],
+        block['nonce'])
+
+
+def encode_block(block):
+    if block.get('version') != HEADER_BLOCK_VERSION:
+        raise ValueError(f'block version {block.get("version")} has no binary form')
+    parts = [pack_header(block), _LENGTH.pack(len(block['transactions']))]
+    for transaction in block['transactions']:
+        data = encode_transaction(transaction)
+        parts.append(_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def _decode_block(reader):
+    (version, previous_hash, merkle_root,
+     timestamp, difficulty, nonce) = struct.unpack(
+         BLOCK_HEADER_FORMAT, reader.read(BLOCK_HEADER_SIZE))
+    if version != HEADER_BLOCK_VERSION:
+        raise ValueError(f'unknown block version: {version}')
+    transactions = [decode_transaction(reader.read_chunk())
+                    for _ in range(reader.unpack(_LENGTH))]
+    return utils.sorted_dict_by_key({
+        'timestamp': timestamp,
+        'difficulty': difficulty,
+        'transactions': transactions,
+        'merkle_root': merkle_root.hex(),
+        'nonce': nonce,
+        'previous_hash': previous_hash.hex(),
+        'version': version
+    })
+
+
+def decode_block(data):
+    reader = _Reader(data)
+    block = _decode_block(reader)
+    reader.finish()
+    return block
+
+
+def chain_prefix(count):
+    """ count個のブロックのレコードの前に置くチェーンの先頭部分 """
+    return _LENGTH.pack(count)
+
+
+def encode_chain(chain):
+    parts = [chain_prefix(len(chain))]
+    for block in chain:
+        data = encode_block(block)
+        parts.append(_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def decode_chain(data):
+    reader = _Reader(data)
+    chain = [decode_block(reader.read_chunk())
+             for _ in range(reader.unpack(_LENGTH))]
+    reader.finish()
+    return chain
+
+
+def blocks_since_prefix(height, count):
+    """ 高さheightから始まるcount個のブロックのレコードの前に置く部分 """
+    return _HEIGHT.pack(height) + chain_prefix(count)
+
+
+def encode_blocks_since(height, blocks):
+    return _HEIGHT.pack(height) + encode_chain(blocks)
+
+
+def decode_blocks_since(data):
+    """ (最初のブロックの高さ, ブロックのリスト)．形式が不正ならValueError """
+    if len(data) < _HEIGHT.size:
+        raise ValueError('truncated data')
+    (height,) = _HEIGHT.unpack_from(data)
+    return height, decode_chain(memoryview(data)[_HEIGHT.size:])
+
+
+def debug_json(data):
+    """ バイナリのブロック(またはトランザクション)をJSONで見る """
+    if len(data) >= BLOCK_HEADER_SIZE and data[:4] == struct.pack('>I', HEADER_BLOCK_VERSION):
+        return json.dumps(decode_block(data), indent=2)
+    return json.dumps(decode_transaction(data), indent=2)
+
+
+class CodecTest(TestCase):
+
+    ADDRESSES = [encode_address_string(bytes([i + 1]) * ADDRESS_SIZE) for i in range(2)]
+
+    def transactions(self):
+        coinbase = utils.sorted_dict_by_key({
+            'sender_blockchain_address': MINING_SENDER,
+            'recipient_blockchain_address': self.ADDRESSES[0],
+            'value': 1.0
+        })
+        signed = utils.sorted_dict_by_key({
+            'sender_blockchain_address': self.ADDRESSES[0],
+            'recipient_blockchain_address': self.ADDRESSES[1],
+            'value': 0.12345678,
+            'sender_public_key': '04' + 'ab' * 64,
+            'signature': [2 ** 255 + 1, 12345]
+        })
+        return [coinbase, signed]
+
+    def block(self, nonce=0):
+        return utils.sorted_dict_by_key({
+            'timestamp': 1600000000.5,
+            'difficulty': 3,
+            'transactions': self.transactions(),
+            'merkle_root': '11' * 32,
+            'nonce': nonce,
+            'previous_hash': '22' * 32,
+            'version': HEADER_BLOCK_VERSION
+        })
+
+    def test_transaction_round_trip(self):
+        for transaction in self.transactions():
+            data = encode_transaction(transaction)
+            self.assertEqual(decode_transaction(data), transaction)
+        unsigned = encode_transaction(self.transactions()[1], signed=False)
+        self.assertEqual(decode_transaction(unsigned),
+                         {k: v for k, v in self.transactions()[1].items()
+                          if k not in ('sender_public_key', 'signature')})
+
+    def test_block_and_chain_round_trip(self):
+        block = self.block()
+        data = encode_block(block)
+        self.assertEqual(data[:BLOCK_HEADER_SIZE], pack_header(block))
+        self.assertEqual(decode_block(data), block)
+        chain = [self.block(i) for i in range(3)]
+        self.assertEqual(decode_chain(encode_chain(chain)), chain)
+        self.assertEqual(decode_blocks_since(encode_blocks_since(5, chain[1:])),
+                         (5, chain[1:]))
+        self.assertEqual(decode_chain(encode_chain([])), [])
+
+    def test_malformed(self):
+        data = encode_chain([self.block()])
+        for bad in (data[:-1], data + b'\x00', data[:3], b''):
+            with self.assertRaises(ValueError):
+                decode_chain(bad)
+        with self.assertRaises(ValueError):
+            decode_blocks_since(b'\x00' * 4)
+        with self.assertRaises(ValueError):
+            encode_block({**self.block(), 'version': 2})
+        with self.assertRaises(ValueError):
+            encode_transaction({**self.transactions()[0], 'value': -1.0})
+        with self.assertRaises(ValueError):
+            encode_transaction({**self.transactions()[1], 'sender_blockchain_address': 'x'})
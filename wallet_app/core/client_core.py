@@ -1,8 +1,8 @@
 import socket
 import time
 import pickle
-import json
 
+import codec
 import utils
 from blockchain import BlockChain
 from wallet import Wallet
@@ -13,7 +13,8 @@ from p2p.message_manager import (
     MSG_KEY_INFO,
     MSG_REQUEST_KEY_INFO,
     MSG_REQUEST_FULL_CHAIN,
-    MSG_NEW_TRANSACTION
+    MSG_NEW_TRANSACTION,
+    BINARY_PAYLOAD_TYPES
 )
 
 
@@ -96,7 +97,14 @@ class ClientCore:
             ConnectionManager4Edgeに引き渡すコールバックの中身。
         """
         if msg[2] == RSP_FULL_CHAIN:
-            new_block_chain = json.loads(msg[4])
+            if not isinstance(msg[4], BINARY_PAYLOAD_TYPES):
+                print('received chain is invalid')
+                return
+            try:
+                new_block_chain = codec.decode_chain(msg[4])
+            except ValueError:
+                print('received chain is invalid')
+                return
             result = self.blockchain.resolve_conflicts(new_block_chain)
             if result is not None:
                 self.callback()
@@ -6,6 +6,7 @@ import threading
 import contextlib
 import random
 
+import codec
 import utils
 from blockchain import (
     BlockChain,
@@ -14,6 +15,10 @@ from blockchain import (
     MINING_TIMER_SEC
 )
 from wallet import Wallet
+from blockstore import BlockStore
+from mempool import transaction_key
+from crypt.backend import DEFAULT_BACKEND, set_backend
+from core.signature_verifier import SignatureVerifier
 from p2p.connection_manager import ConnectionManager
 from p2p.message_manager import (
     MSG_NEW_TRANSACTION,
@@ -22,7 +27,10 @@ from p2p.message_manager import (
     RSP_FULL_CHAIN,
     MSG_KEY_INFO,
     MSG_REQUEST_KEY_INFO,
-    MSG_DELETE_TRANSACTION
+    MSG_REQUEST_BLOCKS,
+    RSP_BLOCKS,
+    OK_WITHOUT_PAYLOAD,
+    BINARY_PAYLOAD_TYPES
 )
 
 STATE_INIT = 0
@@ -32,9 +40,13 @@ STATE_SHUTTING_DOWN = 3
 
 class ServerCore:
 
-    def __init__(self, my_port=50082, core_node_host=None, core_node_port=None):
+    def __init__(self, my_port=50082, core_node_host=None, core_node_port=None,
+                 crypto_backend=DEFAULT_BACKEND, verify_workers=0,
+                 mining_workers=0, data_dir=None):
         self.server_state = STATE_INIT
         print('Initializing server...')
+        set_backend(crypto_backend)
+        print('Crypto backend is set to ... ', crypto_backend)
         self.my_ip = utils.get_host()
         print('Server IP address is set to ... ', self.my_ip)
         self.my_port = my_port
@@ -42,7 +54,16 @@ class ServerCore:
         self.core_node_host = core_node_host
         self.core_node_port = core_node_port
         self.miners_wallet = Wallet()
-        self.blockchain = BlockChain(self.miners_wallet.blockchain_address)
+        # data_dirを指定するとブロックを保存し，再起動時は保存済みの末尾から再開する
+        self.store = BlockStore(data_dir) if data_dir is not None else None
+        self.blockchain = BlockChain(self.miners_wallet.blockchain_address,
+                                     self.store)
+        # 署名検証用のワーカープロセス
+        # 0なら作らず，BlockChainが公開鍵のキャッシュを使って自プロセスで検証する
+        self.verifier = SignatureVerifier(verify_workers) if verify_workers > 0 else None
+        self.blockchain.signature_verifier = self.verifier
+        # ナンス探索用のワーカープロセス数(0なら採掘スレッドで探す)
+        self.blockchain.mining_processes = mining_workers
         self.mining_semaphore = threading.Semaphore(1)
         self.__print_info()
         
@@ -68,6 +89,7 @@ class ServerCore:
         if self.core_node_host is not None:
             self.server_state = STATE_CONNECTED_TO_NETWORK
             self.cm.join_network(self.core_node_host, self.core_node_port)
+            self.request_blocks_since_tip()
         else:
             print('This server is runnning as Genesis Core Node...')
 
@@ -78,6 +100,21 @@ class ServerCore:
         self.server_state = STATE_SHUTTING_DOWN
         print('Shutdown server...')
         self.cm.connection_close()
+        if self.verifier is not None:
+            self.verifier.shutdown()
+        if self.store is not None:
+            self.store.close()
+
+    def request_blocks_since_tip(self):
+        """
+            手元のチェーンの末尾より後のブロックだけを接続先のCoreノードに要求する
+        """
+        tip = {
+            'height': len(self.blockchain.chain) - 1,
+            'hash': self.blockchain.last_block_hash()
+        }
+        new_message = self.cm.get_message_text(MSG_REQUEST_BLOCKS, json.dumps(tip))
+        self.cm.send_msg((self.core_node_host, self.core_node_port), new_message)
 
     
     def start_mining(self):
@@ -100,19 +137,19 @@ class ServerCore:
         nonce = self.blockchain.proof_of_work()
         if nonce == -1:
             return False
-        previous_hash = self.blockchain.hash(self.blockchain.chain[-1])
+        previous_hash = self.blockchain.last_block_hash()
         is_created, block = self.blockchain.create_block(nonce, previous_hash)
         if not is_created:
             return False
-        self.delete_transaction_for_all_peer()
 
         print({'action': 'mining', 'status': 'success'})
         utils.pprint(self.blockchain.chain)
+        print('crypto cache stats : ', self.get_cache_info())
 
         self.send_all_chain_for_consensus()
 
         elapse = round(time.time() - start, 4)
-        self.blockchain.difficulty_adjustment(elapse)
+        self.blockchain.difficulty_adjustment(elapse, self.blockchain.hashrate)
 
         # print('mining speed : ', str(round(self.mining_speed, 3)))
         # print('difficult : ', str(self.difficulty))
@@ -120,81 +157,172 @@ class ServerCore:
         return True
 
 
-    def delete_transaction_for_all_peer(self):
+    def get_cache_info(self):
         """
-            ノードのトランザクションプールをからにするメッセージの送信
+            署名検証まわりのキャッシュのヒット数・ミス数
         """
-        new_message = self.cm.get_message_text(MSG_DELETE_TRANSACTION)
-        self.cm.send_msg_to_all_peer(new_message)
+        return {
+            'public_key': self.blockchain.public_key_cache.info(),
+            'signature': self.blockchain.signature_cache.info()
+        }
 
     def send_all_chain_for_consensus(self):
         """
             チェーンを全てのノードに送信してコンセンサス
         """
-        my_chain = self.blockchain.chain
-        chain_data = json.dumps(my_chain)
-        new_message = self.cm.get_message_text(RSP_FULL_CHAIN, chain_data)
-        self.cm.send_msg_to_all_peer(new_message)
+        self.__send_chain(None, RSP_FULL_CHAIN)
+
+    def __send_chain(self, peer, msg_type, start=0):
+        """
+            高さstart以降のブロックをバイナリのままpeer(Noneなら全てのノード)に送信
+            保存済みのブロックはblocks.datからsendfileで送り，チェーンの大きさに比例する
+            コピーをPython側で作らない
+        """
+        frame = self.cm.get_frame(msg_type)
+        # チェーンを置き換える側と同じロックの中で，長さを比べて送る範囲のファイルを開く
+        # (開いたファイルはその後truncateされても中身が変わらない)
+        with self.blockchain.transaction_pool.lock:
+            if self.store is not None and len(self.store) == len(self.blockchain.chain):
+                count, file_range = self.store.file_range(start)
+                if msg_type == RSP_BLOCKS:
+                    frame += codec.blocks_since_prefix(start, count)
+                else:
+                    frame += codec.chain_prefix(count)
+                body = b''
+            else:
+                # 保存していない(またはストアが追いついていない)ときはその場で組み立てる
+                blocks = self.blockchain.chain[start:]
+                if msg_type == RSP_BLOCKS:
+                    body = codec.encode_blocks_since(start, blocks)
+                else:
+                    body = codec.encode_chain(blocks)
+                file_range = None
+        try:
+            if peer is None:
+                self.cm.send_frame_to_all_peer(frame, body, file_range)
+            else:
+                self.cm.send_frame(peer, frame, body, file_range)
+        finally:
+            if file_range is not None:
+                file_range[0].close()
 
     def __handle_message(self, msg, is_core, peer=None):
         """
             ConnectionManagerに引き渡すコールバックの中身。
         """
         print('message_type : ', msg[2])
-        if peer is not None:
+        if msg[1] == OK_WITHOUT_PAYLOAD:
             if msg[2] == MSG_REQUEST_FULL_CHAIN:
                 # walletのチェーンを同期
                 print('Send our latest blockchain for reply to : ', peer)
-                my_chain = self.blockchain.chain
-                chain_data = json.dumps(my_chain)
-                new_message = self.cm.get_message_text(RSP_FULL_CHAIN, chain_data)
-                self.cm.send_msg(peer, new_message)
+                self.__send_chain(peer, RSP_FULL_CHAIN)
             elif msg[2] == MSG_REQUEST_KEY_INFO:
                 # walletにminerの鍵情報を渡す
                 key_info = pickle.dumps(self.miners_wallet, 0).decode()
                 m_type = MSG_KEY_INFO
                 message = self.cm.get_message_text(m_type, key_info)
                 self.cm.send_msg(peer, message)
-            elif msg[2] == MSG_DELETE_TRANSACTION:
-                # transaction poolを空に
-                print('DELETE_TRANSACTION is called')
-                self.blockchain.transaction_pool = []
         else:
             if msg[2] == MSG_NEW_TRANSACTION:
                 print('NEW_TRANSACTION command is called')
                 payload = json.loads(msg[4])
-                new_transaction = utils.sorted_dict_by_key({
-                    'sender_blockchain_address': payload['sender_blockchain_address'],
-                    'recipient_blockchain_address': payload['recipient_blockchain_address'],
-                    'value': float(payload['value'])
-                })
-                current_transactions = self.blockchain.transaction_pool.copy()
+                signature = pickle.loads(payload['signature'].encode('utf8'))
+                new_transaction = self.blockchain.signed_transaction(
+                    utils.sorted_dict_by_key({
+                        'sender_blockchain_address': payload['sender_blockchain_address'],
+                        'recipient_blockchain_address': payload['recipient_blockchain_address'],
+                        'value': float(payload['value'])
+                    }),
+                    payload['sender_public_key'], signature)
                 print('new transaction : ', new_transaction)
-                if new_transaction in current_transactions:
+                try:
+                    txid = transaction_key(new_transaction)
+                except ValueError as ex:
+                    print('transaction is malformed : ', ex)
+                    return
+                if txid in self.blockchain.transaction_pool:
                     print('transaction is already in pool')
                     return
                 else:
-                    signature = pickle.loads(payload['signature'].encode('utf8'))
                     print('signature', signature)
-                    is_transacted = self.blockchain.add_transaction(
-                        payload['sender_blockchain_address'],
-                        payload['recipient_blockchain_address'],
-                        payload['value'],
-                        payload['sender_public_key'], signature
-                    )
-                    if is_transacted:
-                        print('new transaction is generated')
-                        print('\n\ntransaction_pool', self.blockchain.transaction_pool)
-                    if not is_core:
-                        # ウォレットからのトランザクションはブロードキャスト
-                        print('transaction bloadcasted')
-                        m_type = MSG_NEW_TRANSACTION
-                        new_message = self.cm.get_message_text(m_type, msg[4])
-                        self.cm.send_msg_to_all_peer(new_message)             
+                    cache_key = self.blockchain.signature_cache_key(
+                        new_transaction, payload['sender_public_key'], signature)
+                    if self.verifier is None:
+                        is_valid = self.blockchain.verify_transaction_signature(
+                            payload['sender_public_key'], signature, new_transaction)
+                        self.__add_new_transaction(
+                            is_valid, cache_key, payload, signature, msg, is_core)
+                        return
+                    # 署名検証はワーカープロセスに任せ，結果が返ってきたらプールに追加する
+                    public_key = self.blockchain.parse_public_key(
+                        payload['sender_public_key'])
+                    if public_key is None:
+                        items = []
+                    else:
+                        z, _, r, s = cache_key
+                        items = [(public_key, z, r, s)]
+                    future = self.verifier.submit(items)
+                    future.add_done_callback(
+                        lambda f: self.__add_new_transaction(
+                            any(f.result()), cache_key, payload, signature, msg, is_core))
             elif msg[2] == RSP_FULL_CHAIN:
                 print('RSP_FULL_CHAIN command is called')
                 if not is_core:
                     return
+                if not isinstance(msg[4], BINARY_PAYLOAD_TYPES):
+                    print('received chain is not binary')
+                    return
 
-                new_block_chain = json.loads(msg[4])
-                self.blockchain.resolve_conflicts(new_block_chain)
\ No newline at end of file
+                try:
+                    new_block_chain = codec.decode_chain(msg[4])
+                except ValueError as ex:
+                    print('received chain is malformed : ', ex)
+                    return
+                self.blockchain.resolve_conflicts(new_block_chain)
+            elif msg[2] == MSG_REQUEST_BLOCKS:
+                # 要求元の末尾が自分のチェーンにあればその後だけ，なければチェーン全体を返す
+                print('Send blocks since the requested tip to : ', peer)
+                tip = json.loads(msg[4])
+                blocks = self.blockchain.blocks_since(tip['hash'], tip['height'])
+                if blocks is None:
+                    self.__send_chain(peer, RSP_FULL_CHAIN)
+                else:
+                    self.__send_chain(peer, RSP_BLOCKS, tip['height'] + 1)
+            elif msg[2] == RSP_BLOCKS:
+                print('RSP_BLOCKS command is called')
+                if not is_core:
+                    return
+                if not isinstance(msg[4], BINARY_PAYLOAD_TYPES):
+                    print('received blocks are not binary')
+                    return
+
+                try:
+                    height, blocks = codec.decode_blocks_since(msg[4])
+                except ValueError as ex:
+                    print('received blocks are malformed : ', ex)
+                    return
+                self.blockchain.extend_chain(height, blocks)
+
+    def __add_new_transaction(self, is_valid, cache_key, payload, signature, msg, is_core):
+        """
+            署名検証の結果を受けてトランザクションをプールに追加
+        """
+        if is_valid:
+            self.blockchain.signature_cache.put(cache_key, True)
+            is_transacted = self.blockchain.add_transaction(
+                payload['sender_blockchain_address'],
+                payload['recipient_blockchain_address'],
+                payload['value'],
+                payload['sender_public_key'], signature
+            )
+            if is_transacted:
+                print('new transaction is generated')
+                print('\n\ntransaction_pool', self.blockchain.transaction_pool.transactions())
+        else:
+            print('invalid signature')
+        if not is_core:
+            # ウォレットからのトランザクションはブロードキャスト
+            print('transaction bloadcasted')
+            m_type = MSG_NEW_TRANSACTION
+            new_message = self.cm.get_message_text(m_type, msg[4])
+            self.cm.send_msg_to_all_peer(new_message)
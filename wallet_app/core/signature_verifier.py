@@ -0,0 +1,118 @@
+import functools
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from crypt.backend import BACKENDS, get_backend
+
+logger = logging.getLogger(__name__)
+
+# 1つのワーカーにまとめて渡す署名の件数
+VERIFY_CHUNK_SIZE = 256
+# ワーカープロセス内で保持する公開鍵の件数
+WORKER_KEY_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=len(BACKENDS))
+def _worker_backend(backend_name):
+    return BACKENDS[backend_name]()
+
+
+@functools.lru_cache(maxsize=WORKER_KEY_CACHE_SIZE)
+def _worker_key(backend_name, public_key):
+    try:
+        return _worker_backend(backend_name).load_public_key(public_key)
+    except ValueError:
+        return None
+
+
+def verify_items(backend_name, items):
+    """
+        (公開鍵(x, y), z, r, s)のリストを検証してboolのリストを返す
+        ワーカープロセス側で実行されるので，引数も返り値もpickleできるintとboolだけにする
+    """
+    backend = _worker_backend(backend_name)
+    results = [False] * len(items)
+    loaded = []
+    indices = []
+    for i, (public_key, z, r, s) in enumerate(items):
+        key = _worker_key(backend_name, public_key)
+        if key is not None:
+            loaded.append((key, z, r, s))
+            indices.append(i)
+    for i, is_valid in zip(indices, backend.verify_many(loaded)):
+        results[i] = is_valid
+    return results
+
+
+class SignatureVerifier:
+    """
+        署名検証を別プロセスで行うサービス
+        楕円曲線の計算はGILでハンドラのスレッドに直列化されるので，
+        ProcessPoolExecutorに投げて複数コアで検証する
+        ワーカー数が0のときやプールが使えなくなったときは自プロセスで検証する
+    """
+
+    def __init__(self, max_workers=0, chunk_size=VERIFY_CHUNK_SIZE):
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.executor = None
+        if max_workers > 0:
+            try:
+                self.executor = ProcessPoolExecutor(max_workers=max_workers)
+            except (OSError, ValueError, NotImplementedError) as ex:
+                logger.error({'action': 'SignatureVerifier', 'ex': ex})
+
+    def submit(self, items):
+        """
+            itemsの検証を非同期に行い，boolのリストを結果に持つFutureを返す
+            投げた後にワーカーが落ちてプールが壊れた場合も自プロセスで検証し直して結果を返す
+        """
+        items = list(items)
+        backend_name = get_backend().name
+        future = Future()
+        if self.executor is not None:
+            try:
+                pending = self.executor.submit(verify_items, backend_name, items)
+            except (BrokenProcessPool, RuntimeError) as ex:
+                self.__fallback(ex)
+            else:
+                pending.add_done_callback(
+                    lambda f: self.__settle(future, f, backend_name, items))
+                return future
+        future.set_result(verify_items(backend_name, items))
+        return future
+
+    def verify_many(self, items):
+        """
+            itemsをchunk_sizeずつワーカーに分けて検証し，結果がそろうまで待つ
+        """
+        items = list(items)
+        chunks = [items[i:i + self.chunk_size]
+                  for i in range(0, len(items), self.chunk_size)]
+        futures = [self.submit(chunk) for chunk in chunks]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def __settle(self, future, pending, backend_name, items):
+        """
+            ワーカーの結果をfutureに移す．プールが壊れていたら自プロセスで検証する
+        """
+        try:
+            future.set_result(pending.result())
+        except BrokenProcessPool as ex:
+            self.__fallback(ex)
+            future.set_result(verify_items(backend_name, items))
+        except Exception as ex:
+            future.set_exception(ex)
+
+    def __fallback(self, ex):
+        logger.error({'action': 'SignatureVerifier', 'fallback': 'in-process', 'ex': ex})
+        self.shutdown()
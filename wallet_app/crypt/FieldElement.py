@@ -2,6 +2,9 @@
 
 class FieldElement(object):
     """ 有限体の要素 """
+    # 大量に作られるので__dict__を持たせない
+    __slots__ = ('num', 'prime')
+
     def __init__(self, num, prime):
         if num<0 or num>=prime:
             error = f'{num} not in field range to {prime-1}'
@@ -20,6 +23,10 @@ class FieldElement(object):
     def __ne__(self, other):
         return not (self == other)
 
+    # __slots__のクラスをpickle(プロトコル0)できるようにする
+    def __reduce__(self):
+        return (self.__class__, (self.num, self.prime))
+
     """ 演算子をモジュロ演算でオーバーロード 
 
     self.primeを法としたmod演算を定義
@@ -5,6 +5,8 @@ class Point(object):
     """ 楕円曲線上の点 
     楕円曲線y^2 = x^3 + ax + b上の点を表現
     """
+    __slots__ = ('x', 'y', 'a', 'b')
+
     def __init__(self, x, y, a, b):
         self.a = a
         self.b = b
@@ -25,6 +27,9 @@ class Point(object):
     def __ne__(self, other):
         return not (self == other)
 
+    def __reduce__(self):
+        return (self.__class__, (self.x, self.y, self.a, self.b))
+
     def __repr__(self):
         # 無限遠点
         if self.x is None:
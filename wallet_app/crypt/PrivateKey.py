@@ -1,45 +1,43 @@
-from .S256 import G, N
+import hashlib
+import hmac
+
+from .S256 import G, N, _batch_inverse, _batch_to_affine, _fixed_base_mul
 from .Signature import Signature
+from .helper import encode_base58_checksum
 
 class PrivateKey(object):
 
     def __init__(self, secret):
         self.secret = secret
-        self.point = secret * G
+        self._point = None
+
+    @property
+    def point(self):
+        # 署名するだけなら公開点は要らないので必要になるまで計算しない
+        if self._point is None:
+            self._point = self.secret * G
+        return self._point
 
     def hex(self):
         return '{:x}'.format(self.secret).zfill(64)
 
-    def sign(self, z):
+    def sign(self, z, k=None):
         # zのフォーマットは何？
-        k = 1234567890987654321 # 本来ランダムでもっと大きい k = self.deterministic_k(z)
+        if k is None:
+            k = self.deterministic_k(z)
         # ｢的｣のx座標を計算
-        r = (k * G).x.num
+        R = k * G
+        r = R.x.num
         k_inv = pow(k, N-2, N)
         s = (z + r * self.secret) * k_inv % N
-        if s > N / 2:
+        # 検証側で計算される点s^-1(zG + rP)のyが偶数になるようにsの符号を選ぶ
+        # (一括検証でrからRを一意に復元できるようにするため)
+        if R.y.num % 2 == 1:
             s = N - s
         return Signature(r, s)
 
     def deterministic_k(self, z):
-        k = b'\x00' * 32
-        v = b'\x01' * 32
-        if z > N:
-            z -= N
-        z_bytes = z.to_bytes(32, 'big')
-        secret_bytes = self.secret.to_bytes(32, 'big')
-        s256 = hashlib.sha256
-        k = hmac.new(k, v + b'\x00' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        k = hmac.new(k, v + b'\x01' + secret_bytes + z_bytes, s256).digest()
-        v = hmac.new(k, v, s256).digest()
-        while True:
-            v = hmac.new(k, v, s256).digest()
-            candidate = int.from_bytes(v, 'big')
-            if candidate >= 1 and candidate < N:
-                return candidate
-            k = hmac.new(k, v + b'\x00', s256).digest()
-            v = hmac.new(k, v, s256).digest()
+        return deterministic_k(self.secret, z)
 
     # tag::source6[]
     def wif(self, compressed=True, testnet=False):
@@ -54,7 +52,59 @@ class PrivateKey(object):
             suffix = b''
         return encode_base58_checksum(prefix + secret_bytes + suffix)
     # end::source6[]
-    
+
+
+class Signer(object):
+    """ 1つの秘密鍵で多数の署名ハッシュに署名する
+    鍵ごとに一度作って使い回す．公開点は計算しない
+    ナンス点k*Gは固定基点テーブルで求め，アフィンへの変換とkの逆元は
+    まとめて署名する分を同時逆元計算で1回ずつの逆元計算にする
+    """
+
+    def __init__(self, secret):
+        self.secret = secret
+
+    def sign(self, z):
+        return self.sign_many([z])[0]
+
+    def sign_many(self, zs):
+        """ zsの各署名ハッシュに署名し，Signatureのリストを返す """
+        ks = [deterministic_k(self.secret, z) for z in zs]
+        nonce_points = _batch_to_affine([_fixed_base_mul(k) for k in ks])
+        k_invs = _batch_inverse(ks, N)
+        signatures = []
+        for z, (r, y), k_inv in zip(zs, nonce_points, k_invs):
+            s = (z + r * self.secret) * k_inv % N
+            # PrivateKey.signと同じくRのyが偶数になるようにsの符号を選ぶ
+            if y % 2 == 1:
+                s = N - s
+            signatures.append(Signature(r, s))
+        return signatures
+
+
+def deterministic_k(secret, z):
+    """ RFC 6979による署名用の乱数kの決定的な生成
+    秘密鍵と署名ハッシュzだけから決まるので，鍵オブジェクトを作らずに使える
+    """
+    k = b'\x00' * 32
+    v = b'\x01' * 32
+    if z > N:
+        z -= N
+    z_bytes = z.to_bytes(32, 'big')
+    secret_bytes = secret.to_bytes(32, 'big')
+    s256 = hashlib.sha256
+    k = hmac.new(k, v + b'\x00' + secret_bytes + z_bytes, s256).digest()
+    v = hmac.new(k, v, s256).digest()
+    k = hmac.new(k, v + b'\x01' + secret_bytes + z_bytes, s256).digest()
+    v = hmac.new(k, v, s256).digest()
+    while True:
+        v = hmac.new(k, v, s256).digest()
+        candidate = int.from_bytes(v, 'big')
+        if candidate >= 1 and candidate < N:
+            return candidate
+        k = hmac.new(k, v + b'\x00', s256).digest()
+        v = hmac.new(k, v, s256).digest()
+
 
 if __name__ == '__main__':
     e = PrivateKey(1234567890)
@@ -3,6 +3,10 @@ from .Point import Point
 
 from .helper import encode_base58_checksum
 from .helper import hash160
+import functools
+import random
+import threading
+from unittest import TestCase
 #import hmac
 #from io import BytesIO
 #from random import randint
@@ -15,21 +19,489 @@ P = 2**256 - 2**32 - 977
 # 有限巡回群の位数
 N = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
 
+
+""" ヤコビアン座標での点演算
+
+(X, Y, Z)はアフィン座標(X/Z^2, Y/Z^3)を表す
+加算・2倍算で逆元計算(pow(x, P-2, P))が不要になるため，
+スカラー倍の途中はすべて素のintで計算して最後に一度だけアフィンに戻す
+Z == 0 は無限遠点
+"""
+
+_INFINITY = (0, 1, 0)
+
+
+def _jacobian_double(p):
+    """ 2倍算 (a = 0 の曲線用, dbl-2009-l) """
+    X1, Y1, Z1 = p
+    if Z1 == 0 or Y1 == 0:
+        return _INFINITY
+    XX = X1 * X1 % P
+    YY = Y1 * Y1 % P
+    YYYY = YY * YY % P
+    S = 2 * ((X1 + YY) ** 2 - XX - YYYY) % P
+    M = 3 * XX % P
+    X3 = (M * M - 2 * S) % P
+    Y3 = (M * (S - X3) - 8 * YYYY) % P
+    Z3 = 2 * Y1 * Z1 % P
+    return (X3, Y3, Z3)
+
+
+def _jacobian_add(p, q):
+    """ ヤコビアン座標同士の加算 (add-1998-cmo-2) """
+    X1, Y1, Z1 = p
+    X2, Y2, Z2 = q
+    if Z1 == 0:
+        return q
+    if Z2 == 0:
+        return p
+    Z1Z1 = Z1 * Z1 % P
+    Z2Z2 = Z2 * Z2 % P
+    U1 = X1 * Z2Z2 % P
+    U2 = X2 * Z1Z1 % P
+    S1 = Y1 * Z2 * Z2Z2 % P
+    S2 = Y2 * Z1 * Z1Z1 % P
+    H = (U2 - U1) % P
+    R = (S2 - S1) % P
+    if H == 0:
+        # 同じ点なら2倍算，x軸対称なら無限遠点
+        if R == 0:
+            return _jacobian_double(p)
+        return _INFINITY
+    HH = H * H % P
+    HHH = H * HH % P
+    V = U1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - S1 * HHH) % P
+    Z3 = Z1 * Z2 * H % P
+    return (X3, Y3, Z3)
+
+
+def _jacobian_add_affine(p, q):
+    """ ヤコビアン座標とアフィン座標(x, y)の加算 (Z2 = 1 として乗算を省略) """
+    X1, Y1, Z1 = p
+    x2, y2 = q
+    if Z1 == 0:
+        return (x2, y2, 1)
+    Z1Z1 = Z1 * Z1 % P
+    U2 = x2 * Z1Z1 % P
+    S2 = y2 * Z1 * Z1Z1 % P
+    H = (U2 - X1) % P
+    R = (S2 - Y1) % P
+    if H == 0:
+        if R == 0:
+            return _jacobian_double(p)
+        return _INFINITY
+    HH = H * H % P
+    HHH = H * HH % P
+    V = X1 * HH % P
+    X3 = (R * R - HHH - 2 * V) % P
+    Y3 = (R * (V - X3) - Y1 * HHH) % P
+    Z3 = Z1 * H % P
+    return (X3, Y3, Z3)
+
+
+def _jacobian_mul(k, q):
+    """ アフィン座標の点q = (x, y)のk倍をヤコビアン座標で返す (左から右のdouble-and-add) """
+    result = _INFINITY
+    for bit in bin(k)[2:]:
+        result = _jacobian_double(result)
+        if bit == '1':
+            result = _jacobian_add_affine(result, q)
+    return result
+
+
+def _jacobian_to_affine(p):
+    """ ヤコビアン座標をアフィン座標(x, y)に戻す．無限遠点はNone """
+    X, Y, Z = p
+    if Z == 0:
+        return None
+    z_inv = pow(Z, P - 2, P)
+    z_inv2 = z_inv * z_inv % P
+    return (X * z_inv2 % P, Y * z_inv2 * z_inv % P)
+
+
+def _batch_to_affine(points):
+    """ 複数のヤコビアン座標をまとめてアフィンに戻す
+
+    Montgomeryの同時逆元計算で，逆元計算(pow)を全体で1回に抑える
+    無限遠点はNoneになる
+    """
+    prefix = []
+    acc = 1
+    for X, Y, Z in points:
+        prefix.append(acc)
+        if Z != 0:
+            acc = acc * Z % P
+    acc_inv = pow(acc, P - 2, P)
+    result = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        if Z == 0:
+            continue
+        z_inv = acc_inv * prefix[i] % P
+        acc_inv = acc_inv * Z % P
+        z_inv2 = z_inv * z_inv % P
+        result[i] = (X * z_inv2 % P, Y * z_inv2 * z_inv % P)
+    return result
+
+
+""" Gの固定基点テーブル
+
+G_TABLE_WINDOWビットずつ区切った窓iについて j * 2^(G_TABLE_WINDOW*i) * G (j = 1..2^w-1)
+をアフィン座標で持っておく．k*Gは窓ごとに表を引いて足すだけになり，2倍算が不要
+テーブルは初めて使うときに一度だけ作る
+"""
+
+G_TABLE_WINDOW = 6
+
+# 点→アドレスのキャッシュの件数
+ADDRESS_CACHE_SIZE = 4096
+
+_g_table = None
+_g_table_lock = threading.Lock()
+
+
+def _build_g_table():
+    width = 1 << G_TABLE_WINDOW
+    windows = (N.bit_length() + G_TABLE_WINDOW - 1) // G_TABLE_WINDOW
+    base = (G.x.num, G.y.num, 1)
+    jacobian_points = []
+    for _ in range(windows):
+        current = base
+        for _ in range(1, width):
+            jacobian_points.append(current)
+            current = _jacobian_add(current, base)
+        # currentは 2^w * base
+        base = current
+    affine_points = _batch_to_affine(jacobian_points)
+    return [affine_points[i:i + width - 1]
+            for i in range(0, len(affine_points), width - 1)]
+
+
+def _get_g_table():
+    global _g_table
+    if _g_table is None:
+        with _g_table_lock:
+            if _g_table is None:
+                _g_table = _build_g_table()
+    return _g_table
+
+
+def _fixed_base_mul(k):
+    """ k*Gをヤコビアン座標で返す (固定基点テーブルを使うので加算のみ) """
+    mask = (1 << G_TABLE_WINDOW) - 1
+    result = _INFINITY
+    for row in _get_g_table():
+        digit = k & mask
+        if digit:
+            result = _jacobian_add_affine(result, row[digit - 1])
+        k >>= G_TABLE_WINDOW
+    return result
+
+""" 複数スカラー倍の同時計算 (Strauss-Shamir法, interleaved wNAF)
+
+k1*Q1 + k2*Q2 + ... を2倍算を共有しながら一度に計算する
+各スカラーは幅wのwNAF(非零の桁は奇数で，非零の桁の間に少なくともw-1個の0が入る)に変換し，
+Qの奇数倍 Q, 3Q, ..., (2^(w-1)-1)Q をアフィン座標で用意しておく
+"""
+
+# 任意の点(公開鍵など)に使う窓幅
+WNAF_WINDOW = 5
+# Gは奇数倍の表を一度だけ作るので広い窓幅を使う
+G_WNAF_WINDOW = 8
+
+_g_odd_multiples = None
+
+
+def _wnaf(k, width):
+    """ kを幅widthのwNAFに変換する(下位桁から順に並べたリスト) """
+    digits = []
+    window = 1 << width
+    half = window >> 1
+    while k:
+        if k & 1:
+            digit = k & (window - 1)
+            if digit >= half:
+                digit -= window
+            k -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        k >>= 1
+    return digits
+
+
+def _odd_multiples(q, width):
+    """ アフィン座標の点qから [q, 3q, 5q, ..., (2^(width-1)-1)q] をアフィン座標で返す """
+    count = 1 << (width - 2)
+    q_jacobian = (q[0], q[1], 1)
+    double_q = _jacobian_double(q_jacobian)
+    multiples = [q_jacobian]
+    for _ in range(count - 1):
+        multiples.append(_jacobian_add(multiples[-1], double_q))
+    return _batch_to_affine(multiples)
+
+
+def _get_g_odd_multiples():
+    global _g_odd_multiples
+    if _g_odd_multiples is None:
+        with _g_table_lock:
+            if _g_odd_multiples is None:
+                _g_odd_multiples = _odd_multiples(
+                    (G.x.num, G.y.num), G_WNAF_WINDOW)
+    return _g_odd_multiples
+
+
+def _multi_mul(terms):
+    """ Σ k_i * Q_i をヤコビアン座標で返す
+
+    termsは (スカラー, _odd_multiplesで作った奇数倍の表, 窓幅) のリスト
+    """
+    nafs = [(_wnaf(k, width), table) for k, table, width in terms]
+    length = max((len(naf) for naf, _ in nafs), default=0)
+    result = _INFINITY
+    for i in range(length - 1, -1, -1):
+        result = _jacobian_double(result)
+        for naf, table in nafs:
+            if i >= len(naf):
+                continue
+            digit = naf[i]
+            if digit > 0:
+                result = _jacobian_add_affine(result, table[digit >> 1])
+            elif digit < 0:
+                x, y = table[(-digit) >> 1]
+                result = _jacobian_add_affine(result, (x, P - y))
+    return result
+
+
+""" GLV法による自己準同型を使ったスカラー倍
+
+secp256k1には φ(x, y) = (βx, y) = λ(x, y) という計算の軽い自己準同型がある
+(β^3 ≡ 1 mod P, λ^3 ≡ 1 mod N)
+k = k1 + k2*λ (mod N) と約128ビットの2つに分けると
+k*Q = k1*Q + k2*φ(Q) となり，2倍算の回数がおよそ半分になる
+"""
+
+GLV_BETA = 0x7ae96a2b657c07106e64479eac3434e99cf0497512f58995c1396c28719501ee
+GLV_LAMBDA = 0x5363ad4cc05c30e0a5261c028812645a122e22ea20816678df02967c1b23bd72
+# k分解に使う格子の基底 (a1 + b1*λ ≡ a2 + b2*λ ≡ 0 mod N)
+_GLV_A1 = 0x3086d221a7d46bcde86c90e49284eb15
+_GLV_B1 = -0xe4437ed6010e88286f547fa90abfe4c3
+_GLV_A2 = 0x114ca50f7a8e2f3f657c1108d9d44cfd8
+_GLV_B2 = _GLV_A1
+
+_g_endo_odd_multiples = None
+
+
+def _glv_split(k):
+    """ k ≡ k1 + k2*λ (mod N) となる約128ビットの(k1, k2)を返す(負になることもある) """
+    c1 = (_GLV_B2 * k + N // 2) // N
+    c2 = (-_GLV_B1 * k + N // 2) // N
+    k1 = k - c1 * _GLV_A1 - c2 * _GLV_A2
+    k2 = -c1 * _GLV_B1 - c2 * _GLV_B2
+    return k1, k2
+
+
+def _endomorphism(table):
+    """ 点の表の各点にφを適用する (x座標にβを掛けるだけ) """
+    return [(GLV_BETA * x % P, y) for x, y in table]
+
+
+def _signed_term(k, table, width):
+    """ 負のスカラーは点の符号を反転した表で正のスカラーにする """
+    if k < 0:
+        return (-k, [(x, P - y) for x, y in table], width)
+    return (k, table, width)
+
+
+def _glv_terms(k, table, endo_table, width):
+    k1, k2 = _glv_split(k)
+    return [_signed_term(k1, table, width), _signed_term(k2, endo_table, width)]
+
+
+def _get_g_endo_odd_multiples():
+    global _g_endo_odd_multiples
+    if _g_endo_odd_multiples is None:
+        _g_endo_odd_multiples = _endomorphism(_get_g_odd_multiples())
+    return _g_endo_odd_multiples
+
+
+def _glv_g_terms(k):
+    return _glv_terms(k, _get_g_odd_multiples(), _get_g_endo_odd_multiples(),
+                      G_WNAF_WINDOW)
+
+
+def _point_tables(q):
+    table = _odd_multiples(q, WNAF_WINDOW)
+    return (table, _endomorphism(table))
+
+
+def _glv_point_terms(k, q, tables=None):
+    if tables is None:
+        tables = _point_tables(q)
+    return _glv_terms(k, tables[0], tables[1], WNAF_WINDOW)
+
+
+def _glv_mul(k, q):
+    """ アフィン座標の点qのk倍をヤコビアン座標で返す (GLV法 + Strauss法) """
+    return _multi_mul(_glv_point_terms(k, q))
+
+
+def _pippenger(pairs):
+    """ Σ k_i * Q_i をヤコビアン座標で返す (Pippengerのバケット法)
+
+    pairsは (スカラー, アフィン座標の点) のリスト
+    点の数が多いときはStrauss法より加算回数が大幅に少ない
+    """
+    if not pairs:
+        return _INFINITY
+    width = min(max(len(pairs).bit_length() - 3, 2), 12)
+    mask = (1 << width) - 1
+    bits = max(k.bit_length() for k, _ in pairs)
+    result = _INFINITY
+    for window in range((bits + width - 1) // width - 1, -1, -1):
+        for _ in range(width):
+            result = _jacobian_double(result)
+        shift = window * width
+        buckets = [_INFINITY] * mask
+        for k, q in pairs:
+            digit = (k >> shift) & mask
+            if digit:
+                buckets[digit - 1] = _jacobian_add_affine(buckets[digit - 1], q)
+        # Σ digit * bucket[digit] を累積和2本で求める
+        running = _INFINITY
+        total = _INFINITY
+        for bucket in reversed(buckets):
+            running = _jacobian_add(running, bucket)
+            total = _jacobian_add(total, running)
+        result = _jacobian_add(result, total)
+    return result
+
+
+def _batch_inverse(values, modulus):
+    """ valuesの各要素のmodulusを法とした逆元をまとめて求める (Montgomeryの同時逆元計算) """
+    prefix = []
+    acc = 1
+    for value in values:
+        prefix.append(acc)
+        acc = acc * value % modulus
+    acc_inv = pow(acc, modulus - 2, modulus)
+    result = [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        result[i] = acc_inv * prefix[i] % modulus
+        acc_inv = acc_inv * values[i] % modulus
+    return result
+
+
+def _lift_x(x):
+    """ x座標からyが偶数の点(x, y)を復元する．曲線上にない場合はNone """
+    if not 0 <= x < P:
+        return None
+    alpha = (pow(x, 3, P) + B) % P
+    y = pow(alpha, (P + 1) // 4, P)
+    if y * y % P != alpha:
+        return None
+    if y & 1:
+        y = P - y
+    return (x, y)
+
+
+def public_points(secrets):
+    """ 複数の秘密鍵の公開点をまとめて求める
+    k*Gはヤコビアン座標のまま計算し，アフィンへの変換は同時逆元計算で全体で1回の逆元計算にする
+    """
+    jacobian_points = [_fixed_base_mul(secret % N) for secret in secrets]
+    return [S256Point(None, None) if affine is None
+            else S256Point._from_affine(*affine)
+            for affine in _batch_to_affine(jacobian_points)]
+
+
+def sequential_public_points(start, count):
+    """ 秘密鍵start, start+1, ..., start+count-1の公開点を求める
+    最初の点以外はGを1回足すだけで求まる
+    秘密鍵どうしの関係が分かってしまうので負荷試験用のウォレットなどに限って使う
+    """
+    current = _fixed_base_mul(start % N)
+    jacobian_points = [current]
+    g = (G.x.num, G.y.num)
+    for _ in range(count - 1):
+        current = _jacobian_add_affine(current, g)
+        jacobian_points.append(current)
+    return [S256Point(None, None) if affine is None
+            else S256Point._from_affine(*affine)
+            for affine in _batch_to_affine(jacobian_points)]
+
+
+def multi_scalar_mul(scalars, points):
+    """ Σ scalars[i] * points[i] をS256Pointで返す
+    各項はGLV法で2つに分け，GはGの奇数倍の表を使い，それ以外の点は都度表を作る
+    """
+    terms = []
+    for k, point in zip(scalars, points):
+        k %= N
+        if k == 0 or point.x is None:
+            continue
+        if point._is_generator():
+            terms.extend(_glv_g_terms(k))
+        else:
+            terms.extend(_glv_point_terms(k, point._affine()))
+    return S256Point._from_jacobian(_multi_mul(terms))
+
+
 class S256Field(FieldElement):
-    
+    """ secp256k1の有限体の要素
+    位数はPに決まっているので，演算では位数の比較や範囲の検査をせずに結果の要素を作る
+    """
+    __slots__ = ()
+
     def __init__(self, num, prime=None):
         super().__init__(num=num, prime=P)
 
+    @classmethod
+    def _from_int(cls, num):
+        """ 0 <= num < P が分かっている値から検査なしで要素を作る """
+        element = object.__new__(cls)
+        element.num = num
+        element.prime = P
+        return element
+
     def __repr__(self):
         return '{:x}'.format(self.num).zfill(64)
 
+    def __add__(self, other):
+        return self._from_int((self.num + other.num) % P)
+
+    def __sub__(self, other):
+        return self._from_int((self.num - other.num) % P)
+
+    def __mul__(self, other):
+        return self._from_int(self.num * other.num % P)
+
+    def __pow__(self, exponent):
+        return self._from_int(pow(self.num, exponent % (P - 1), P))
+
+    def __truediv__(self, other):
+        return self._from_int(self.num * pow(other.num, P - 2, P) % P)
+
+    def __rmul__(self, coefficient):
+        return self._from_int(self.num * coefficient % P)
+
     def sqrt(self):
-        return self**((P + 1 ) /4)
+        return self**((P + 1) // 4)
+
+
+# 曲線の係数は全ての点で共有する
+_A_FIELD = S256Field(A)
+_B_FIELD = S256Field(B)
+
 
 class S256Point(Point):
-    
+    # _tablesはprecompute()で作る奇数倍の表
+    __slots__ = ('_tables',)
+
     def __init__(self, x, y, a=None, b=None):
-        a, b = S256Field(A), S256Field(B)
+        a, b = _A_FIELD, _B_FIELD
         if type(x) == int:
             super().__init__(x=S256Field(x), y=S256Field(y), a=a, b=b)
         else:
@@ -43,7 +515,43 @@ class S256Point(Point):
 
     def __rmul__(self, coefficient):
         coef = coefficient % N
-        return super().__rmul__(coef)
+        if self.x is None or coef == 0:
+            return self.__class__(None, None)
+        # Gは固定基点テーブルの方が速い(2倍算が一切ない)のでそちらを使う
+        if self._is_generator():
+            return self._from_jacobian(_fixed_base_mul(coef))
+        return self._from_jacobian(_glv_mul(coef, self._affine()))
+
+    def precompute(self):
+        """ 公開鍵のように何度も検証に使う点の奇数倍の表を作って保持しておく """
+        if self.x is not None:
+            self._tables = _point_tables(self._affine())
+        return self
+
+    def _is_generator(self):
+        return self.x.num == G.x.num and self.y.num == G.y.num
+
+    def _affine(self):
+        """ 内部計算用に素のintのタプル(x, y)を返す """
+        return (self.x.num, self.y.num)
+
+    @classmethod
+    def _from_affine(cls, x, y):
+        """ 計算結果など曲線上にあることが分かっている座標から検査なしで点を作る """
+        point = object.__new__(cls)
+        point.x = S256Field._from_int(x)
+        point.y = S256Field._from_int(y)
+        point.a = _A_FIELD
+        point.b = _B_FIELD
+        return point
+
+    @classmethod
+    def _from_jacobian(cls, p):
+        """ ヤコビアン座標の計算結果からS256Pointを作る(逆元計算はここで一度だけ) """
+        affine = _jacobian_to_affine(p)
+        if affine is None:
+            return cls(None, None)
+        return cls._from_affine(*affine)
 
     def verify(self, z, sig):
         """ 署名の検証
@@ -52,13 +560,24 @@ class S256Point(Point):
         sigはSignatureオブジェクトでrとsを持つ
         totalとsig,rが一致すれば署名が有効と判定
         """
+        # r, sは1以上N未満 (s + Nなどを受け入れると一括検証やecdsaと結果が食い違う)
+        if self.x is None or not 0 < sig.r < N or not 0 < sig.s < N:
+            return False
         s_inv = pow(sig.s, N - 2, N)
         # u = z / s
         u = z * s_inv % N
         # v = r / s
         v = sig.r * s_inv % N
-        total = u * G + v * self
-        return total.x.num == sig.r
+        # u*G + v*selfはGLV法で4つの約128ビットの項に分け，
+        # 2倍算を共有して同時に計算する(Strauss-Shamir法)
+        # x座標の比較もX == r*Z^2で行うので最後の逆元計算が要らない
+        X, _, Z = _multi_mul(_glv_g_terms(u) + _glv_point_terms(
+            v, self._affine(), getattr(self, '_tables', None)))
+        if Z == 0:
+            return False
+        # x mod N == r を確かめる(x >= Nとなるのはr + N < Pの場合だけ)
+        zz = Z * Z % P
+        return X == sig.r * zz % P or (sig.r + N < P and X == (sig.r + N) * zz % P)
 
     def sec(self, compressed=True):
         ''' 公開鍵のシリアライズ
@@ -78,12 +597,7 @@ class S256Point(Point):
 
     def address(self, compressed=True, testnet=False):
         '''Returns the address string'''
-        h160 = self.hash160(compressed)
-        if testnet:
-            prefix = b'\x6f'
-        else:
-            prefix = b'\x00'
-        return encode_base58_checksum(prefix + h160)
+        return _address(self.x.num, self.y.num, compressed, testnet)
 
     @classmethod
     def parse(self, sec_bin):
@@ -113,9 +627,47 @@ class S256Point(Point):
             return S256Point(x, odd_beta)
         
 
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _address(x, y, compressed, testnet):
+    """ 同じ公開鍵のアドレスを何度も求めるのでhash160とチェックサムの計算をキャッシュする """
+    h160 = S256Point._from_affine(x, y).hash160(compressed)
+    if testnet:
+        prefix = b'\x6f'
+    else:
+        prefix = b'\x00'
+    return encode_base58_checksum(prefix + h160)
+
+
 G = S256Point(
     0x79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798,
     0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8)
 
+class GLVTest(TestCase):
+    """ GLV法の結果を従来のdouble-and-add(Point.__rmul__)と突き合わせる """
+
+    def test_split(self):
+        for _ in range(100):
+            k = random.randrange(N)
+            k1, k2 = _glv_split(k)
+            self.assertEqual((k1 + k2 * GLV_LAMBDA) % N, k)
+            self.assertLess(abs(k1).bit_length(), 130)
+            self.assertLess(abs(k2).bit_length(), 130)
+
+    def test_endomorphism(self):
+        self.assertEqual(GLV_LAMBDA * G, S256Point(GLV_BETA * G.x.num % P, G.y.num))
+
+    def test_variable_base(self):
+        point = Point.__rmul__(G, random.randrange(1, N))
+        for k in [1, 2, N - 1, GLV_LAMBDA, random.randrange(N), random.randrange(N)]:
+            self.assertEqual(k * point, Point.__rmul__(point, k))
+        self.assertIsNone((N * point).x)
+
+    def test_multi_scalar(self):
+        point = Point.__rmul__(G, random.randrange(1, N))
+        u, v = random.randrange(N), random.randrange(N)
+        want = Point.__add__(Point.__rmul__(G, u), Point.__rmul__(point, v))
+        self.assertEqual(multi_scalar_mul([u, v], [G, point]), want)
+
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -3,4 +3,5 @@ from .helper import *
 from .Point import *
 from .PrivateKey import *
 from .Signature import *
-from .S256 import *
\ No newline at end of file
+from .S256 import *
+from .batch import *
\ No newline at end of file
@@ -0,0 +1,216 @@
+from unittest import TestCase, skipUnless
+
+from .PrivateKey import PrivateKey, Signer, deterministic_k
+from .S256 import G, N, P, S256Point
+from .Signature import Signature
+from .batch import verify_batch
+
+try:
+    from ecdsa import SECP256k1
+    from ecdsa import ecdsa as ecdsa_core
+    from ecdsa import ellipticcurve
+    from ecdsa import numbertheory
+except ImportError:
+    SECP256k1 = None
+
+
+""" 暗号処理のバックエンド
+
+鍵生成・署名・署名検証・公開鍵の復元をまとめたインターフェース
+スクラッチ実装(crypt)を基準のバックエンドとし，ecdsaパッケージを使うものを選択できるようにする
+公開鍵は(x, y)のintのタプル，署名は(r, s)のintのタプルでやり取りする
+検証にはload_public_keyで検証済みの鍵オブジェクトにしたものを渡す(キャッシュして使い回せる)
+"""
+
+DEFAULT_BACKEND = 'scratch'
+
+
+class CryptoBackend(object):
+    name = None
+
+    def keygen(self, secret):
+        """ 秘密鍵から公開鍵(x, y)を計算する """
+        raise NotImplementedError
+
+    def sign(self, secret, z):
+        """ 署名ハッシュzに署名して(r, s)を返す
+        kはRFC 6979で決め，s^-1(zG + rP)のyが偶数になるようにsの符号を選ぶ
+        """
+        raise NotImplementedError
+
+    def sign_many(self, secret, zs):
+        """ 1つの秘密鍵で複数の署名ハッシュに署名して(r, s)のリストを返す """
+        return [self.sign(secret, z) for z in zs]
+
+    def load_public_key(self, public_key):
+        """ (x, y)を曲線上の点か確認して検証用の鍵オブジェクトにする
+        曲線上にない場合はValueError
+        """
+        raise NotImplementedError
+
+    def verify(self, key, z, r, s):
+        """ keyはload_public_keyの返り値 """
+        raise NotImplementedError
+
+    def verify_many(self, items):
+        """ (鍵オブジェクト, z, r, s)のリストをまとめて検証し，boolのリストを返す """
+        return [self.verify(key, z, r, s) for key, z, r, s in items]
+
+    def decompress(self, sec_bin):
+        """ SEC形式の公開鍵から(x, y)を復元する """
+        raise NotImplementedError
+
+
+class ScratchBackend(CryptoBackend):
+    """ スクラッチ実装(cryptパッケージ)を使う基準のバックエンド """
+    name = 'scratch'
+
+    def keygen(self, secret):
+        point = secret * G
+        return (point.x.num, point.y.num)
+
+    def sign(self, secret, z):
+        return self.sign_many(secret, [z])[0]
+
+    def sign_many(self, secret, zs):
+        return [(sig.r, sig.s) for sig in Signer(secret).sign_many(zs)]
+
+    def load_public_key(self, public_key):
+        return S256Point(*public_key).precompute()
+
+    def verify(self, key, z, r, s):
+        return key.verify(z, Signature(r, s))
+
+    def verify_many(self, items):
+        return verify_batch(items)
+
+    def decompress(self, sec_bin):
+        point = S256Point.parse(sec_bin)
+        return (point.x.num, point.y.num)
+
+
+class EcdsaBackend(CryptoBackend):
+    """ ecdsaパッケージを使うバックエンド """
+    name = 'ecdsa'
+
+    def __init__(self):
+        if SECP256k1 is None:
+            raise RuntimeError('ecdsa package is not installed')
+        self.generator = SECP256k1.generator
+        self.curve = self.generator.curve()
+
+    def keygen(self, secret):
+        point = self.generator * secret
+        return (point.x(), point.y())
+
+    def sign(self, secret, z):
+        k = deterministic_k(secret, z)
+        R = self.generator * k
+        r = R.x()
+        s = numbertheory.inverse_mod(k, N) * (z + secret * r) % N
+        if R.y() % 2 == 1:
+            s = N - s
+        return (r, s)
+
+    def load_public_key(self, public_key):
+        try:
+            point = ellipticcurve.Point(self.curve, public_key[0], public_key[1])
+            return ecdsa_core.Public_key(self.generator, point)
+        except (AssertionError, RuntimeError) as e:
+            raise ValueError(f'{public_key} is not a valid public key') from e
+
+    def verify(self, key, z, r, s):
+        return key.verifies(z, ecdsa_core.Signature(r, s))
+
+    def decompress(self, sec_bin):
+        x = int.from_bytes(sec_bin[1:33], 'big')
+        if sec_bin[0] == 4:
+            return (x, int.from_bytes(sec_bin[33:65], 'big'))
+        alpha = (pow(x, 3, P) + self.curve.b()) % P
+        beta = numbertheory.square_root_mod_prime(alpha, P)
+        if (beta % 2 == 0) == (sec_bin[0] == 2):
+            return (x, beta)
+        return (x, P - beta)
+
+
+BACKENDS = {
+    ScratchBackend.name: ScratchBackend,
+    EcdsaBackend.name: EcdsaBackend,
+}
+
+_backend = ScratchBackend()
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(name):
+    """ 使用するバックエンドを切り替える(ノード起動時に設定から呼ぶ) """
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError(f'unknown crypto backend: {name}')
+    _backend = BACKENDS[name]()
+    return _backend
+
+
+@skipUnless(SECP256k1 is not None, 'ecdsa package is not installed')
+class BackendParityTest(TestCase):
+    """ 同じ入力に対してスクラッチ実装とecdsaが同じ結果を返すかを確認する """
+
+    SECRETS = [1, 2, 12345, 0xdeadbeef12345, N - 1,
+               0x8b387de39861728c92ec9f589c303b1038ff60eb3963b12cd212263a1d1e0f00]
+    HASHES = [1, 0xbc62d4b80d9e36da29c16c5d4d9f11731f36052c72401a76c23c0fb5a9b74423,
+              N + 5, 2**256 - 1]
+
+    def setUp(self):
+        self.scratch = ScratchBackend()
+        self.ecdsa = EcdsaBackend()
+
+    def test_keygen(self):
+        for secret in self.SECRETS:
+            self.assertEqual(self.scratch.keygen(secret), self.ecdsa.keygen(secret))
+
+    def test_sign(self):
+        for secret in self.SECRETS:
+            for z in self.HASHES:
+                self.assertEqual(self.scratch.sign(secret, z % N),
+                                 self.ecdsa.sign(secret, z % N))
+            zs = [z % N for z in self.HASHES]
+            self.assertEqual(self.scratch.sign_many(secret, zs),
+                             self.ecdsa.sign_many(secret, zs))
+            self.assertEqual(
+                [(sig.r, sig.s) for sig in map(PrivateKey(secret).sign, zs)],
+                self.scratch.sign_many(secret, zs))
+
+    def test_verify(self):
+        for secret in self.SECRETS:
+            public_key = self.scratch.keygen(secret)
+            scratch_key = self.scratch.load_public_key(public_key)
+            ecdsa_key = self.ecdsa.load_public_key(public_key)
+            for z in self.HASHES:
+                z %= N
+                r, s = self.scratch.sign(secret, z)
+                cases = [(z, r, s), (z, r, N - s), ((z + 1) % N, r, s), (z, s, r),
+                         # 範囲外のr, s
+                         (z, r, s + N), (z, 0, s), (z, r + N, s), (z, N, s), (z, r, 0)]
+                for case in cases:
+                    self.assertEqual(self.scratch.verify(scratch_key, *case),
+                                     self.ecdsa.verify(ecdsa_key, *case))
+                self.assertEqual(
+                    self.scratch.verify_many([(scratch_key,) + c for c in cases]),
+                    self.ecdsa.verify_many([(ecdsa_key,) + c for c in cases]))
+
+    def test_load_public_key(self):
+        x, y = self.scratch.keygen(12345)
+        for backend in (self.scratch, self.ecdsa):
+            with self.assertRaises(ValueError):
+                backend.load_public_key((x, y + 1))
+
+    def test_decompress(self):
+        for secret in self.SECRETS:
+            point = PrivateKey(secret).point
+            for compressed in (True, False):
+                sec_bin = point.sec(compressed)
+                self.assertEqual(self.scratch.decompress(sec_bin),
+                                 self.ecdsa.decompress(sec_bin))
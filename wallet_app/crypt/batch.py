@@ -0,0 +1,78 @@
+import secrets
+
+from .S256 import (
+    N,
+    P,
+    _batch_inverse,
+    _fixed_base_mul,
+    _jacobian_add,
+    _lift_x,
+    _pippenger,
+)
+from .Signature import Signature
+
+# これより少ない件数は一括にせず1件ずつ検証する
+BATCH_MIN_SIZE = 4
+# 乱数係数のビット数 (不正な署名が一括検証を通る確率は2^-BATCH_RANDOMIZER_BITS程度)
+BATCH_RANDOMIZER_BITS = 128
+
+
+def verify_batch(items):
+    """ 署名の一括検証
+
+    itemsは (公開鍵のS256Point, 署名ハッシュz, r, s) のリスト
+    各署名の R = s^-1(zG + rP) をrから復元し(yは偶数とする)，
+    乱数係数a_iを掛けて Σa_i*u_i*G + Σa_i*v_i*P_i - Σa_i*R_i が無限遠点になるかを
+    一度のマルチスカラー倍で確かめる
+    一括検証に失敗したら半分ずつに分けて調べ直し，最後は1件ずつ検証して不正な署名を特定する
+    返り値はitemsと同じ順のboolのリスト
+    """
+    items = list(items)
+    results = [False] * len(items)
+    candidates = []
+    for i, (point, z, r, s) in enumerate(items):
+        if point.x is None or not 0 < r < N or not 0 < s < N:
+            continue
+        candidates.append(i)
+    _verify_indices(items, candidates, results)
+    return results
+
+
+def _verify_indices(items, indices, results):
+    if len(indices) < BATCH_MIN_SIZE:
+        for i in indices:
+            point, z, r, s = items[i]
+            results[i] = point.verify(z, Signature(r, s))
+        return
+    if _verify_together([items[i] for i in indices]):
+        for i in indices:
+            results[i] = True
+        return
+    half = len(indices) // 2
+    _verify_indices(items, indices[:half], results)
+    _verify_indices(items, indices[half:], results)
+
+
+def _verify_together(items):
+    s_invs = _batch_inverse([s for _, _, _, s in items], N)
+    g_scalar = 0
+    # 同じ公開鍵の項は係数をまとめて1つの点にする
+    key_scalars = {}
+    pairs = []
+    for (point, z, r, s), s_inv in zip(items, s_invs):
+        R = _lift_x(r)
+        if R is None:
+            return False
+        a = secrets.randbits(BATCH_RANDOMIZER_BITS) | 1
+        g_scalar += a * z * s_inv
+        key = point._affine()
+        key_scalars[key] = (key_scalars.get(key, 0) + a * r * s_inv) % N
+        # -a*R は点の符号を反転して足す
+        pairs.append((a, (R[0], P - R[1])))
+    pairs.extend((k, key) for key, k in key_scalars.items() if k)
+    total = _jacobian_add(_fixed_base_mul(g_scalar % N), _pippenger(pairs))
+    return total[2] == 0
+
+
+if __name__ == '__main__':
+    pass
@@ -7,6 +7,14 @@ import hashlib
 BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 # end::source1[]
 
+# 文字→値の表
+_BASE58_INDEX = {c: i for i, c in enumerate(BASE58_ALPHABET)}
+# 2桁分(0〜58^2-1)をまとめて文字列にする表
+_BASE58_PAIRS = [a + b for a in BASE58_ALPHABET for b in BASE58_ALPHABET]
+# 多倍長整数の割り算はこの単位(10桁)でまとめて行う
+_BASE58_CHUNK_DIGITS = 10
+_BASE58_CHUNK = 58 ** _BASE58_CHUNK_DIGITS
+
 
 def run(test):
     suite = TestSuite()
@@ -28,19 +36,21 @@ def hash256(s):
 
 # tag::source2[]
 def encode_base58(s):
-    count = 0
-    for c in s:  # <1>
-        if c == 0:
-            count += 1
-        else:
-            break
+    '''先頭の0x00は'1'にし，残りは58^10ごとに区切って2桁ずつ表で文字にする'''
+    count = len(s) - len(s.lstrip(b'\x00'))
     num = int.from_bytes(s, 'big')
-    prefix = '1' * count
-    result = ''
-    while num > 0:  # <2>
-        num, mod = divmod(num, 58)
-        result = BASE58_ALPHABET[mod] + result
-    return prefix + result  # <3>
+    chunks = []
+    while num > 0:
+        num, chunk = divmod(num, _BASE58_CHUNK)
+        chunks.append(chunk)
+    pairs = []
+    for chunk in chunks:
+        for _ in range(_BASE58_CHUNK_DIGITS // 2):
+            chunk, pair = divmod(chunk, 58 * 58)
+            pairs.append(_BASE58_PAIRS[pair])
+    # 最上位のチャンクの0埋め分('1')は取り除く
+    result = ''.join(reversed(pairs)).lstrip('1')
+    return '1' * count + result
 # end::source2[]
 
 
@@ -52,9 +62,15 @@ def encode_base58_checksum(b):
 
 def decode_base58(s):
     num = 0
-    for c in s:
-        num *= 58
-        num += BASE58_ALPHABET.index(c)
+    try:
+        for i in range(0, len(s), _BASE58_CHUNK_DIGITS):
+            part = s[i:i + _BASE58_CHUNK_DIGITS]
+            value = 0
+            for c in part:
+                value = value * 58 + _BASE58_INDEX[c]
+            num = num * 58 ** len(part) + value
+    except KeyError as e:
+        raise ValueError('bad address: invalid character {}'.format(e))
     combined = num.to_bytes(25, byteorder='big')
     checksum = combined[-4:]
     if hash256(combined[:-4])[:4] != checksum:
@@ -62,6 +78,16 @@ def decode_base58(s):
     return combined[1:-4]
 
 
+def encode_many(payloads):
+    '''複数のペイロードをまとめてBase58Checkにする(アドレスの一覧表示などで使う)'''
+    return [encode_base58_checksum(b) for b in payloads]
+
+
+def decode_many(addresses):
+    '''複数のBase58Checkのアドレスをまとめてhash160に戻す'''
+    return [decode_base58(s) for s in addresses]
+
+
 def little_endian_to_int(b):
     '''little_endian_to_int takes byte sequence as a little-endian number.
     Returns an integer'''
@@ -78,6 +104,21 @@ def int_to_little_endian(n, length):
 
 class HelperTest(TestCase):
 
+    def test_encode_base58(self):
+        h = bytes.fromhex('7c076ff316692a3d7eb3c3bb0f8b1488cf72e1afcd929e29307032997a838a3d')
+        self.assertEqual(encode_base58(h), '9MA8fRQrT4u8Zj8ZRd6MAiiyaxb2Y1CMpvVkHQu5hVM6')
+        h = bytes.fromhex('00eff69ef2b1bd93a66ed5219add4fb51e11a840f404876325a1e8ffe0529a2c')
+        self.assertEqual(encode_base58(h), '14fE3H2E6XMp4SsxtwinF7w9a34ooUrwWe4WsW1458Pd')
+        self.assertEqual(encode_base58(b''), '')
+        self.assertEqual(encode_base58(b'\x00\x00'), '11')
+
+    def test_decode_base58(self):
+        h160s = [bytes(20), bytes(range(20)), b'\xff' * 20]
+        addresses = encode_many([b'\x00' + h for h in h160s])
+        self.assertEqual(decode_many(addresses), h160s)
+        with self.assertRaises(ValueError):
+            decode_base58(addresses[1][:-1] + '0')
+
     def test_little_endian_to_int(self):
         h = bytes.fromhex('99c3980000000000')
         want = 10011545
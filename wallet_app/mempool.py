@@ -0,0 +1,297 @@
+import collections
+import threading
+import time
+from unittest import TestCase
+
+import codec
+
+""" 未承認トランザクションのプール
+
+署名を除いた部分のトランザクションID(transaction_key)をキーに到着順で持ち，
+送金者ごとの索引と未承認の送金額の合計も持つ．重複の確認・取り出しはO(1)
+    署名の(r, s)を(r, N-s)にしたものも検証を通るので，署名を含めたIDをキーにすると
+    中継の途中で書き換えられた同じ送金が別のものとして二重に入ってしまう
+    (署名のkはRFC 6979で決まるので，正しく作った同じ送金は元から同じ署名になる)
+ブロックのテンプレートには到着順で入れる(どのスレッドから見ても同じ順)
+件数・バイト数(バイナリ形式での大きさ)に上限があり，超えた分は追い出す
+    手数料がないので，プールで使っているバイト数が最も多い送金者の一番新しいものから追い出す
+    (1つのアドレスが大量に送っても他の送金者のトランザクションは押し出されない)
+    採掘の報酬(MINING_SENDER)は追い出さない
+プールに入ってからTTL秒を過ぎたものは捨てる
+ハンドラのスレッドと採掘のスレッドから同時に使えるようロックを取る
+    ブロックを反映して残高を変える側も同じlockを取るので，addの残高確認と追加の間に
+    残高が変わることはない
+"""
+
+MEMPOOL_MAX_COUNT = 5000
+MEMPOOL_MAX_BYTES = 1 << 20
+MEMPOOL_TTL_SEC = 60 * 60
+
+def _balance_units(balance):
+    # 残高(float)も最小単位にそろえて比べる
+    return codec.to_units(max(balance, 0.0))
+
+
+def transaction_key(transaction):
+    """ プールのキー．公開鍵と署名を除いたバイト列のトランザクションID """
+    return codec.transaction_id(codec.encode_transaction(transaction, signed=False))
+
+
+# leafはマークル木の葉(署名を含めたバイト列のトランザクションID)
+_Entry = collections.namedtuple('_Entry', ['transaction', 'leaf', 'size', 'units', 'added'])
+
+
+class Mempool(object):
+
+    def __init__(self, max_count=MEMPOOL_MAX_COUNT, max_bytes=MEMPOOL_MAX_BYTES,
+                 ttl=MEMPOOL_TTL_SEC):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+        # トランザクションID -> _Entry (到着順)
+        self._entries = {}
+        # 送金者 -> {トランザクションID: None} (到着順)，使っているバイト数，送金額の合計(最小単位)
+        self._by_sender = {}
+        self._sender_bytes = {}
+        self._debits = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, txid):
+        return txid in self._entries
+
+    def add(self, transaction, balance=None, now=None):
+        """ トランザクションを追加してIDを返す
+        balance(アドレス -> 承認済みの残高)を渡すと，プールにある同じ送金者の送金額と合わせて
+        残高を超えないかを追加と同じロックの中で確かめる
+        すでにある・残高が足りない・上限で追い出された場合はValueError
+        """
+        data = codec.encode_transaction(transaction)
+        txid = transaction_key(transaction)
+        sender = transaction['sender_blockchain_address']
+        units = codec.to_units(transaction['value'])
+        now = time.time() if now is None else now
+        with self.lock:
+            self._expire(now)
+            if txid in self._entries:
+                raise ValueError('duplicate')
+            if (balance is not None and self._debits.get(sender, 0) + units
+                    > _balance_units(balance(sender))):
+                raise ValueError('no_value')
+            self._insert(txid, _Entry(transaction, codec.transaction_id(data),
+                                      len(data), units, now), sender)
+            self._evict()
+            if txid not in self._entries:
+                raise ValueError('pool_full')
+        return txid
+
+    def get(self, txid):
+        with self.lock:
+            entry = self._entries.get(txid)
+            return None if entry is None else entry.transaction
+
+    def items(self, now=None):
+        """ (トランザクションID, トランザクション)のリスト(到着順) """
+        with self.lock:
+            self._expire(time.time() if now is None else now)
+            return [(txid, entry.transaction) for txid, entry in self._entries.items()]
+
+    def block_items(self, now=None):
+        """ ブロックに入れる(マークル木の葉, トランザクション)のリスト(到着順) """
+        with self.lock:
+            self._expire(time.time() if now is None else now)
+            return [(entry.leaf, entry.transaction) for entry in self._entries.values()]
+
+    def transactions(self, now=None):
+        return [transaction for _, transaction in self.items(now)]
+
+    def by_sender(self, blockchain_address):
+        with self.lock:
+            return [self._entries[txid].transaction
+                    for txid in self._by_sender.get(blockchain_address, ())]
+
+    def pending_debit(self, blockchain_address):
+        """ プールにある送金者の未承認の送金額の合計 """
+        with self.lock:
+            return codec.from_units(self._debits.get(blockchain_address, 0))
+
+    def remove(self, txids):
+        """ 指定したIDのトランザクションを取り除き，取り除いたもののリストを返す """
+        removed = []
+        with self.lock:
+            for txid in txids:
+                if txid in self._entries:
+                    removed.append(self._delete(txid))
+        return removed
+
+    def enforce_balances(self, addresses, balance):
+        """ addressesの各送金者について，プールにある送金額の合計が承認済みの残高
+        (balance(アドレス))以下になるまで新しいものから取り除き，取り除いたもののリストを返す
+        """
+        removed = []
+        with self.lock:
+            for address in set(addresses):
+                if address == codec.MINING_SENDER:
+                    continue
+                limit = _balance_units(balance(address))
+                while self._debits.get(address, 0) > limit:
+                    removed.append(self._delete(next(reversed(self._by_sender[address]))))
+        return removed
+
+    def clear(self):
+        with self.lock:
+            self._entries = {}
+            self._by_sender = {}
+            self._sender_bytes = {}
+            self._debits = {}
+            self.total_bytes = 0
+
+    def _insert(self, txid, entry, sender):
+        self._entries[txid] = entry
+        self._by_sender.setdefault(sender, {})[txid] = None
+        self._sender_bytes[sender] = self._sender_bytes.get(sender, 0) + entry.size
+        self._debits[sender] = self._debits.get(sender, 0) + entry.units
+        self.total_bytes += entry.size
+
+    def _delete(self, txid):
+        entry = self._entries.pop(txid)
+        sender = entry.transaction['sender_blockchain_address']
+        del self._by_sender[sender][txid]
+        if self._by_sender[sender]:
+            self._sender_bytes[sender] -= entry.size
+            self._debits[sender] -= entry.units
+        else:
+            del self._by_sender[sender]
+            del self._sender_bytes[sender]
+            del self._debits[sender]
+        self.total_bytes -= entry.size
+        return entry.transaction
+
+    def _expire(self, now):
+        # 到着順に並んでいるので先頭から古いものだけを見ればよい
+        if self.ttl is None:
+            return
+        expired = []
+        for txid, entry in self._entries.items():
+            if now - entry.added < self.ttl:
+                break
+            expired.append(txid)
+        for txid in expired:
+            self._delete(txid)
+
+    def _evict(self):
+        while len(self._entries) > self.max_count or self.total_bytes > self.max_bytes:
+            senders = [s for s in self._sender_bytes if s != codec.MINING_SENDER]
+            if not senders:
+                return
+            sender = max(senders, key=self._sender_bytes.__getitem__)
+            self._delete(next(reversed(self._by_sender[sender])))
+
+
+class MempoolTest(TestCase):
+
+    def setUp(self):
+        self.addresses = [codec.encode_address_string(bytes([i + 1]) * codec.ADDRESS_SIZE)
+                          for i in range(3)]
+
+    def transaction(self, sender, value, recipient=None):
+        return {
+            'sender_blockchain_address': sender,
+            'recipient_blockchain_address': recipient or self.addresses[-1],
+            'value': value
+        }
+
+    def test_duplicate(self):
+        pool = Mempool()
+        txid = pool.add(self.transaction(self.addresses[0], 1.0))
+        self.assertIn(txid, pool)
+        with self.assertRaisesRegex(ValueError, 'duplicate'):
+            pool.add(self.transaction(self.addresses[0], 1.0))
+        self.assertEqual(len(pool), 1)
+
+    def test_duplicate_with_other_signature(self):
+        # 署名だけが違う同じ送金は重複として扱い，ブロックには署名を含めた葉を使う
+        pool = Mempool()
+        transaction = dict(self.transaction(self.addresses[0], 1.0),
+                           sender_public_key='00' * 64, signature=(1, 2))
+        txid = pool.add(transaction)
+        with self.assertRaisesRegex(ValueError, 'duplicate'):
+            pool.add(dict(transaction, signature=(1, 3)))
+        self.assertEqual(txid, transaction_key(dict(transaction, signature=(1, 3))))
+        self.assertEqual(pool.block_items(),
+                         [(codec.transaction_id(codec.encode_transaction(transaction)),
+                           transaction)])
+
+    def test_no_value_boundary(self):
+        sender = self.addresses[0]
+        # 足し引きで誤差の出た残高でも最小単位で同じなら使い切れる
+        pool = Mempool()
+        pool.add(self.transaction(sender, 0.5), lambda address: 0.49999999999999994)
+        with self.assertRaisesRegex(ValueError, 'no_value'):
+            pool.add(self.transaction(sender, 0.00000001), lambda address: 0.5)
+        self.assertEqual(pool.pending_debit(sender), 0.5)
+        pool = Mempool()
+        with self.assertRaisesRegex(ValueError, 'no_value'):
+            pool.add(self.transaction(sender, 0.5), lambda address: 0.49999999)
+        with self.assertRaisesRegex(ValueError, 'no_value'):
+            pool.add(self.transaction(sender, 0.5), lambda address: -1.0)
+
+    def test_evict_biggest_sender_newest(self):
+        a, b = self.addresses[:2]
+        pool = Mempool(max_count=4)
+        for value in (1.0, 2.0, 3.0):
+            pool.add(self.transaction(a, value))
+        pool.add(self.transaction(b, 1.0))
+        pool.add(self.transaction(b, 2.0))
+        self.assertEqual([(t['sender_blockchain_address'], t['value'])
+                          for t in pool.transactions()],
+                         [(a, 1.0), (a, 2.0), (b, 1.0), (b, 2.0)])
+        # 追加した本人が最も多く使っていれば追加したもの自体が追い出される
+        with self.assertRaisesRegex(ValueError, 'pool_full'):
+            pool.add(self.transaction(b, 3.0))
+        self.assertEqual(pool.pending_debit(b), 3.0)
+
+    def test_never_evict_mining_reward(self):
+        pool = Mempool(max_count=3)
+        for recipient in self.addresses:
+            pool.add(self.transaction(codec.MINING_SENDER, 1.0, recipient))
+        with self.assertRaisesRegex(ValueError, 'pool_full'):
+            pool.add(self.transaction(self.addresses[0], 1.0))
+        self.assertEqual(len(pool.by_sender(codec.MINING_SENDER)), 3)
+
+    def test_expire_oldest_first(self):
+        pool = Mempool(ttl=10)
+        pool.add(self.transaction(self.addresses[0], 1.0), now=0)
+        pool.add(self.transaction(self.addresses[1], 2.0), now=5)
+        self.assertEqual(len(pool.items(now=9)), 2)
+        self.assertEqual([t['value'] for t in pool.transactions(now=10)], [2.0])
+        self.assertEqual(pool.pending_debit(self.addresses[0]), 0.0)
+        self.assertEqual(pool.transactions(now=15), [])
+
+    def test_remove_clears_indexes(self):
+        pool = Mempool()
+        txids = [pool.add(self.transaction(sender, value))
+                 for sender in self.addresses[:2] for value in (1.0, 2.0)]
+        removed = pool.remove(txids[:1] + txids[1:] + [bytes(32)])
+        self.assertEqual(len(removed), 4)
+        self.assertEqual((pool._entries, pool._by_sender, pool._sender_bytes, pool._debits),
+                         ({}, {}, {}, {}))
+        self.assertEqual(pool.total_bytes, 0)
+
+    def test_enforce_balances(self):
+        a, b = self.addresses[:2]
+        pool = Mempool()
+        for value in (0.5, 0.3, 0.2):
+            pool.add(self.transaction(a, value))
+        pool.add(self.transaction(b, 1.0))
+        balances = {a: 0.8, b: 5.0}
+        removed = pool.enforce_balances([a, b, codec.MINING_SENDER], balances.get)
+        self.assertEqual([t['value'] for t in removed], [0.2])
+        self.assertEqual(pool.pending_debit(a), 0.8)
+        balances[a] = 0.0
+        pool.enforce_balances([a], balances.get)
+        self.assertEqual(pool.by_sender(a), [])
+        self.assertEqual(len(pool), 1)
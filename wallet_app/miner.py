@@ -0,0 +1,132 @@
+import hashlib
+import multiprocessing
+import time
+
+""" Proof of Workのナンス探索と検証
+
+codec.pack_headerで固定長に詰めたヘッダ(ナンスは末尾の8バイト)のsha256を取り，
+16進表記の先頭difficulty桁が0なら正しいproofとする
+トランザクションはマークルルートとしてヘッダに入るので，ブロックの大きさによらない
+ブロックのハッシュ(次のブロックのprevious_hash)もこのヘッダのハッシュ
+
+ナンスより前の変わらない部分は1回だけsha256に流し込み，その途中状態を.copy()して
+ナンスのバイト列だけを追加で流す
+search_nonce(自プロセス)かparallel_search_nonce(複数プロセスでナンス空間を分担)で行い，
+どちらも(ナンス, 試したナンスの数)を返す
+cancel(threading.Eventなど)がセットされたら探索をやめてナンス-1を返す
+"""
+
+# ブロックヘッダのversion (1, 2はJSONをハッシュしていた頃の形式で，もう使わない)
+HEADER_BLOCK_VERSION = 3
+# 新しく作るブロックのversion
+BLOCK_VERSION = HEADER_BLOCK_VERSION
+# ヘッダ末尾のナンスのバイト数
+NONCE_SIZE = 8
+# この回数ごとにタイムアウトや停止の指示を確認する
+TIMEOUT_CHECK_INTERVAL = 4096
+# 並列探索中にcancelとタイムアウトを確認する間隔(秒)
+CANCEL_POLL_SEC = 0.05
+
+
+def proof_target(difficulty):
+    """ 16進で先頭difficulty桁が0 ⇔ ダイジェスト(32バイト) < 返り値
+    64桁(ダイジェスト全体)を超える難易度はどのダイジェストも満たさない(0が32バイトを返す)
+    """
+    if difficulty <= 0:
+        return None
+    if difficulty > 64:
+        return bytes(32)
+    return (1 << (256 - 4 * difficulty)).to_bytes(33, 'big')[1:]
+
+
+def valid_header_proof(header, difficulty):
+    target = proof_target(difficulty)
+    if target is None:
+        return True
+    return hashlib.sha256(header).digest() < target
+
+
+def _search(prefix, target, start, step, should_stop):
+    """ TIMEOUT_CHECK_INTERVAL回ごとにshould_stop()を確認しながらナンスを探す
+    (ナンス, 試した数)を返す．止められたらナンスは-1
+    """
+    copy = hashlib.sha256(prefix).copy
+    nonce = start
+    attempts = 0
+    while True:
+        for _ in range(TIMEOUT_CHECK_INTERVAL):
+            sha256 = copy()
+            sha256.update(nonce.to_bytes(NONCE_SIZE, 'big'))
+            if sha256.digest() < target:
+                return nonce, attempts + (nonce - start) // step + 1
+            nonce += step
+        attempts += TIMEOUT_CHECK_INTERVAL
+        start = nonce
+        if should_stop():
+            return -1, attempts
+
+
+def _stopper(timeout, cancel):
+    deadline = None if timeout is None else time.time() + timeout
+
+    def should_stop():
+        if cancel is not None and cancel.is_set():
+            return True
+        return deadline is not None and time.time() >= deadline
+    return should_stop
+
+
+def search_nonce(prefix, difficulty, timeout=None, cancel=None):
+    """ prefix(ヘッダのナンスより前の部分)に続けてproofを満たすナンスを0から順に探す
+    (ナンス, 試したナンスの数)を返す．timeout秒を過ぎるかcancelされたらナンスは-1
+    """
+    target = proof_target(difficulty)
+    if target is None:
+        return 0, 1
+    return _search(prefix, target, 0, 1, _stopper(timeout, cancel))
+
+
+def _search_worker(prefix, target, start, step, stop, result, attempts):
+    """ parallel_search_nonceのワーカープロセス
+    見つけたら最初の1つだけresultに書いて全ワーカーを止める
+    """
+    nonce, tried = _search(prefix, target, start, step, stop.is_set)
+    if nonce != -1:
+        with result.get_lock():
+            if result.value == -1:
+                result.value = nonce
+        stop.set()
+    with attempts.get_lock():
+        attempts.value += tried
+
+
+def parallel_search_nonce(prefix, difficulty, processes, timeout=None,
+                          cancel=None):
+    """ ナンス空間をprocesses個のワーカープロセスで分担して探す
+    ワーカーiはi, i+processes, i+2*processes, ...を試す
+    どれかが見つけるか，timeout秒が過ぎるかcancelされると全ワーカーに停止を知らせ，
+    各ワーカーはTIMEOUT_CHECK_INTERVAL回以内に止まる
+    (ナンス, 全ワーカーで試したナンスの数)を返す．見つからなければナンスは-1
+    """
+    target = proof_target(difficulty)
+    if target is None:
+        return 0, 1
+    context = multiprocessing.get_context()
+    stop = context.Event()
+    result = context.Value('q', -1)
+    attempts = context.Value('Q', 0)
+    workers = [
+        context.Process(target=_search_worker, daemon=True,
+                        args=(prefix, target, i, processes, stop, result, attempts))
+        for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    should_stop = _stopper(timeout, cancel)
+    try:
+        while not stop.wait(CANCEL_POLL_SEC) and not should_stop():
+            pass
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+    return result.value, attempts.value
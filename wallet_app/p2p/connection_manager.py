@@ -24,6 +24,8 @@ from .message_manager import (
 
 # 生存確認
 PING_INTERVAL = 10
+# 1回のrecvで受け取る最大のバイト数
+RECV_BUFFER_SIZE = 65536
 
 
 class ConnectionManager:
@@ -78,6 +80,39 @@ class ConnectionManager:
             print('Connection failed for peer : ', peer)
             self.__remove_peer(peer)
 
+    def get_frame(self, msg_type):
+        """
+        バイナリのペイロードを続けて送るメッセージの先頭部分を作成
+        """
+        return self.mm.build_frame(msg_type, self.port)
+
+    def send_frame(self, peer, frame, body=b'', file_range=None):
+        """
+        frame(get_frameの返り値)にbodyを続けて送り，file_rangeを指定するとさらに
+        開いたファイルの一部(ファイル, 位置, 長さ)をsendfileでそのまま送る
+        ファイルは閉じないので，複数のノードに同じものを送れる
+        """
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.connect((peer))
+            print(peer)
+            s.sendall(frame + body)
+            if file_range is not None:
+                f, offset, count = file_range
+                s.sendfile(f, offset, count)
+            s.close()
+        except OSError:
+            print('Connection failed for peer : ', peer)
+            self.__remove_peer(peer)
+
+    def send_frame_to_all_peer(self, frame, body=b'', file_range=None):
+        print('send_frame_to_all_peer was called!')
+        current_list = self.core_node_set.get_list()
+        for peer in current_list:
+            if peer != (self.host, self.port):
+                print("message will be sent to ... ", peer)
+                self.send_frame(peer, frame, body, file_range)
+
     def send_msg_to_all_peer(self, msg):
         print('send_msg_to_all_peer was called!')
         current_list = self.core_node_set.get_list()
@@ -123,7 +158,7 @@ class ConnectionManager:
             print('Waiting for the connection ...')
             soc, addr = self.socket.accept()
             print('Connected by .. ', addr)
-            data_sum = ''
+            data_sum = []
 
             params = (soc, addr, data_sum)
             executor.submit(self.__handle_message, params)
@@ -134,16 +169,15 @@ class ConnectionManager:
         soc, addr, data_sum = params
 
         while True:
-            data = soc.recv(1024)
-            data_sum = data_sum + data.decode('utf-8')
-
+            data = soc.recv(RECV_BUFFER_SIZE)
             if not data:
                 break
+            data_sum.append(data)
 
         if not data_sum:
             return
-            
-        result, reason, cmd, peer_port, payload = self.mm.parse(data_sum)
+
+        result, reason, cmd, peer_port, payload = self.mm.parse(b''.join(data_sum))
         # print(result, reason, cmd, peer_port, payload)
         status = (result, reason)
 
@@ -199,7 +233,7 @@ class ConnectionManager:
                 self.core_node_set.overwrite(new_core_set)
             else:
                 is_core = self.core_node_set.has_this_peer((addr[0], peer_port))
-                self.callback((result, reason, cmd, peer_port, payload), is_core, None)
+                self.callback((result, reason, cmd, peer_port, payload), is_core,  (addr[0], peer_port))
                 return
         else:
             print('Unexpected status', status)
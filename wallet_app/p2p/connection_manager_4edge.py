@@ -19,6 +19,8 @@ from .message_manager import (
 
 # 動作確認用の値。本来は30分(1800)くらいがいいのでは
 PING_INTERVAL = 10
+# 1回のrecvで受け取る最大のバイト数
+RECV_BUFFER_SIZE = 65536
 
 
 class ConnectionManager4Edge(object):
@@ -133,7 +135,7 @@ class ConnectionManager4Edge(object):
             print('Waiting for the connection ...')
             soc, addr = self.socket.accept()
             print('Connected by .. ', addr)
-            data_sum = ''
+            data_sum = []
 
             params = (soc, addr, data_sum)
             executor.submit(self.__handle_message, params)
@@ -145,22 +147,21 @@ class ConnectionManager4Edge(object):
         params :
             soc : 受信したsocketのコネクション
             addr : 送信元のアドレス情報
-            data_sum : 受信したデータを連結するためのベースにする空文字
+            data_sum : 受信したデータを溜めておく空のリスト
         """
 
         soc, addr, data_sum = params
 
         while True:
-            data = soc.recv(1024)
-            data_sum = data_sum + data.decode('utf-8')
-
+            data = soc.recv(RECV_BUFFER_SIZE)
             if not data:
                 break
+            data_sum.append(data)
 
         if not data_sum:
             return
-            
-        result, reason, cmd, peer_port, payload = self.mm.parse(data_sum)
+
+        result, reason, cmd, peer_port, payload = self.mm.parse(b''.join(data_sum))
         print(result, reason, cmd, peer_port, payload)
         status = (result, reason)
 
@@ -1,9 +1,12 @@
 from distutils.version import StrictVersion
 import json
+import struct
 
 
 PROTOCOL_NAME = 'simple_bitcoin_protocol'
-MY_VERSION = '0.1.0'
+MY_VERSION = '0.2.0'
+# これより古いノードとはチェーンの送り方(0.2.0からバイナリ)が違うので受け付けない
+MIN_VERSION = '0.2.0'
 
 MSG_ADD = 0
 MSG_REMOVE = 1
@@ -13,12 +16,15 @@ MSG_PING = 4
 MSG_ADD_AS_EDGE = 5
 MSG_REMOVE_EDGE = 6
 MSG_NEW_TRANSACTION = 7
+# 使わなくなった(各ノードはブロックに入ったトランザクションだけをプールから除く)
 MSG_DELETE_TRANSACTION = 8
 MSG_NEW_BLOCK = 9
 MSG_REQUEST_FULL_CHAIN = 10
 RSP_FULL_CHAIN = 11
 MSG_KEY_INFO = 12
 MSG_REQUEST_KEY_INFO = 13
+MSG_REQUEST_BLOCKS = 14
+RSP_BLOCKS = 15
 
 
 ERR_PROTOCOL_UNMATCH = 0
@@ -26,6 +32,14 @@ ERR_VERSION_UNMATCH = 1
 OK_WITH_PAYLOAD = 2
 OK_WITHOUT_PAYLOAD = 3
 
+# ペイロードがバイナリのメッセージの種類(JSONの文字列で届いたものは受け付けない)
+BINARY_PAYLOAD_TYPES = (bytes, bytearray, memoryview)
+
+# バイナリのペイロードを続けるメッセージの先頭(JSONのメッセージは'{'で始まるので区別できる)
+# FRAME_MAGIC | ヘッダの長さ(4) | ヘッダ(buildのJSON) | ペイロード(バイト列)
+FRAME_MAGIC = b'\x00SBF'
+_FRAME_LENGTH = struct.Struct('>I')
+
 
 class MessageManager:
 
@@ -57,10 +71,26 @@ class MessageManager:
 
         return json.dumps(message)
 
+    def build_frame(self, msg_type, my_port=50082):
+        """
+        バイナリのペイロードを持つプロトコルメッセージの先頭部分の組み立て
+        ペイロードは返り値の後ろにそのまま続けて送る(JSONやbase64にしないのでコピーが増えない)
+
+        return:
+            frame : ペイロードの前に置くバイト列
+        """
+        header = self.build(msg_type, my_port).encode('utf-8')
+        return FRAME_MAGIC + _FRAME_LENGTH.pack(len(header)) + header
+
     def parse(self, msg):
         """
         プロトコルメッセージをパースして返却
+        build_frameのメッセージならペイロードは受信したバイト列のmemoryview
         """
+        if isinstance(msg, (bytes, bytearray)):
+            if msg[:len(FRAME_MAGIC)] == FRAME_MAGIC:
+                return self.__parse_frame(msg)
+            msg = msg.decode('utf-8')
         msg = json.loads(msg)
         msg_ver = StrictVersion(msg['version'])
 
@@ -70,11 +100,22 @@ class MessageManager:
 
         if msg['protocol'] != PROTOCOL_NAME:
             return ('error', ERR_PROTOCOL_UNMATCH, None, None, None)
-        elif msg_ver > StrictVersion(MY_VERSION):
+        elif not StrictVersion(MIN_VERSION) <= msg_ver <= StrictVersion(MY_VERSION):
             return ('error', ERR_VERSION_UNMATCH, None, None, None)
-        elif cmd in (MSG_CORE_LIST, MSG_NEW_TRANSACTION, MSG_NEW_BLOCK, RSP_FULL_CHAIN, MSG_KEY_INFO):
+        elif cmd in (MSG_CORE_LIST, MSG_NEW_TRANSACTION, MSG_NEW_BLOCK, RSP_FULL_CHAIN, MSG_KEY_INFO,
+                     MSG_REQUEST_BLOCKS, RSP_BLOCKS):
             result_type = OK_WITH_PAYLOAD
             return ('ok', result_type, cmd, my_port, payload)
         else:
             result_type = OK_WITHOUT_PAYLOAD
             return ('ok', result_type, cmd, my_port, None)
+
+    def __parse_frame(self, data):
+        start = len(FRAME_MAGIC) + _FRAME_LENGTH.size
+        if len(data) < start:
+            raise ValueError('truncated frame')
+        (length,) = _FRAME_LENGTH.unpack_from(data, len(FRAME_MAGIC))
+        result, reason, cmd, my_port, _ = self.parse(data[start:start + length].decode('utf-8'))
+        if result != 'ok':
+            return (result, reason, cmd, my_port, None)
+        return ('ok', OK_WITH_PAYLOAD, cmd, my_port, memoryview(data)[start + length:])
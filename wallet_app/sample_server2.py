@@ -3,6 +3,7 @@ import sys
 
 from core.server_core import ServerCore
 from utils import get_host
+from crypt.backend import BACKENDS, DEFAULT_BACKEND
 
 my_p2p_server = None
 
@@ -14,10 +15,12 @@ def shutdown_server():
     my_p2p_server.shutdown()
 
 
-def main(my_port, c_host, c_port):
+def main(my_port, c_host, c_port, crypto_backend, verify_workers, mining_workers,
+         data_dir):
     signal.signal(signal.SIGINT, signal_handler)
     global my_p2p_server
-    my_p2p_server = ServerCore(my_port, c_host, c_port) 
+    my_p2p_server = ServerCore(my_port, c_host, c_port, crypto_backend, verify_workers,
+                              mining_workers, data_dir)
     my_p2p_server.start()
     my_p2p_server.join_network()
 
@@ -29,10 +32,19 @@ if __name__ == '__main__':
     parser.add_argument('--c_port', default=5000,type=int)
     parser.add_argument('-p', '--port', default=5001,
                     type=int, help='port to listen on')
+    parser.add_argument('--crypto_backend', default=DEFAULT_BACKEND,
+                    choices=sorted(BACKENDS), help='signature backend')
+    parser.add_argument('--verify_workers', default=0, type=int,
+                    help='number of signature verification processes (0: in-process)')
+    parser.add_argument('--mining_workers', default=0, type=int,
+                    help='number of nonce search processes (0: mining thread)')
+    parser.add_argument('--data_dir', default=None,
+                    help='directory to store blocks in (default: keep the chain in memory)')
 
     args = parser.parse_args()
     c_host = args.c_host
     c_port = args.c_port
     port = args.port
 
-    main(port, c_host, c_port)
\ No newline at end of file
+    main(port, c_host, c_port, args.crypto_backend, args.verify_workers,
+         args.mining_workers, args.data_dir)
\ No newline at end of file
@@ -1,6 +1,7 @@
 import collections
 import logging
 import socket
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -9,6 +10,46 @@ def sorted_dict_by_key(unsorted_dict):
         sorted(unsorted_dict.items(), key=lambda d: d[0]))
 
 
+class LRUCache(object):
+    """ 上限付きのLRUキャッシュ
+    ハンドラのスレッドとマイニングのスレッドから同時に使えるようロックを取る
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize
+        }
+
+
 def pprint(chains):
     for i, chain in enumerate(chains):
         print(f'{"="*25} Chain {i} {"="*25}')
@@ -1,12 +1,13 @@
 import base58
 import codecs
-import hashlib
 import random
 import logging
+import secrets
 import sys
 import time
 import json
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
@@ -18,8 +19,16 @@ from crypt import PrivateKey
 from crypt import Signature
 from crypt import S256Point
 from crypt import P
+from crypt import N
+from crypt import public_points
+from crypt import sequential_public_points
+from crypt.backend import get_backend
+import codec
 import utils
 
+# 一括鍵生成で1回にまとめて計算する鍵の数
+KEYGEN_CHUNK_SIZE = 256
+
 
 class Wallet(object):
     """ 変更点などのメモ
@@ -54,17 +63,79 @@ class Wallet(object):
         self._blockchain_address = self._private_key.address()
 
 
+def generate_keys(count, processes=0, sequential=False,
+                  chunk_size=KEYGEN_CHUNK_SIZE):
+    """ 鍵ペアとアドレスの一括生成
+    (秘密鍵のhex, 公開鍵, アドレス)をcount個，順に返すジェネレータ
+    chunk_size個ずつ公開点を求め，アフィンへの変換の逆元計算をまとめて1回にする
+    processesを指定するとchunkごとに別プロセスで計算する
+    sequential=Trueでは秘密鍵を連番にしてGを足すだけで公開点を求める
+    (秘密鍵どうしの関係が分かるので負荷試験用のウォレット以外には使わない)
+    """
+    start = secrets.randbelow(N - count - 1) + 1 if sequential else None
+    chunks = []
+    for offset in range(0, count, chunk_size):
+        size = min(chunk_size, count - offset)
+        chunks.append((size, None if start is None else start + offset))
+    if processes > 0:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for records in executor.map(_generate_key_chunk, chunks):
+                yield from records
+    else:
+        for chunk in chunks:
+            yield from _generate_key_chunk(chunk)
+
+
+def _generate_key_chunk(chunk):
+    size, start = chunk
+    if start is None:
+        secret_list = [secrets.randbelow(N - 1) + 1 for _ in range(size)]
+        points = public_points(secret_list)
+    else:
+        secret_list = list(range(start, start + size))
+        points = sequential_public_points(start, size)
+    return [('{:x}'.format(secret).zfill(64), str(point.x) + str(point.y),
+             point.address())
+            for secret, point in zip(secret_list, points)]
+
+
+def transaction_hash(sender_blockchain_address, recipient_blockchain_address,
+                     value):
+    """ トランザクションをバイナリ形式にしてsha256でハッシュ化し，署名するint(z)にする """
+    return codec.signing_digest(
+        sender_blockchain_address, recipient_blockchain_address, value)
+
+
+def sign_transactions(sender_private_key, sender_public_key,
+                      sender_blockchain_address, payouts):
+    """ 1つの送金者から複数の宛先への送金をまとめて署名する
+    payoutsは(宛先アドレス, 送金量)のリストで，Transactionのリストを返す
+    ナンス点の計算と逆元計算を全件まとめて行うので1件ずつ署名するより速い
+    """
+    payouts = list(payouts)
+    priv_int = int(sender_private_key, 16)
+    zs = [transaction_hash(sender_blockchain_address, recipient, value)
+          for recipient, value in payouts]
+    signatures = get_backend().sign_many(priv_int, zs)
+    return [Transaction(sender_private_key, sender_public_key,
+                        sender_blockchain_address, recipient, value,
+                        signature=signature)
+            for (recipient, value), signature in zip(payouts, signatures)]
+
+
 class Transaction(object):
 
     def __init__(self, sender_private_key, sender_public_key,
                  sender_blockchain_address, recipient_blockchain_address,
-                 value):
+                 value, signature=None):
         self.sender_private_key = sender_private_key
         self.sender_public_key = sender_public_key
         self.sender_blockchain_address = sender_blockchain_address
         self.recipient_blockchain_address = recipient_blockchain_address
         self.value = value
-        self.signature = self.generate_signature()
+        if signature is None:
+            signature = self.generate_signature()
+        self.signature = signature
 
     def get_json_msg(self):
         msg = {
@@ -79,25 +150,14 @@ class Transaction(object):
 
     def generate_signature(self):
         """ 送金者の秘密鍵でトランザクションに署名
-        トランザクションをsha256でハッシュ化
+        トランザクションをバイナリ形式にしてsha256でハッシュ化
         PrivateKey.sign(message_hash)でSignatureオブジェクトを作成
         署名結果のrとsをタプルで返す
         """
-        sha256 = hashlib.sha256()
-        transaction = utils.sorted_dict_by_key({
-            'sender_blockchain_address': self.sender_blockchain_address,
-            'recipient_blockchain_address': self.recipient_blockchain_address,
-            'value': float(self.value)
-        })
-        sha256.update(str(transaction).encode('utf-8'))
-        message = sha256.digest()
-        msg_hex = message.hex()
-        msg_hex_str = str(msg_hex)
-        msg_hex_str_0x = '0x' + msg_hex_str
+        z = transaction_hash(self.sender_blockchain_address,
+                             self.recipient_blockchain_address, self.value)
         priv_int = int('0x'+self.sender_private_key, 0)
-        priv = PrivateKey(priv_int)
-        sig = priv.sign(int(msg_hex_str_0x, 0))
-        return (sig.r, sig.s)
+        return get_backend().sign(priv_int, z)
 
 if __name__ == '__main__':
     # ウォレットA→Bへの送金テスト 